@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# Benchmarks the exporter and tiler stages over synthetic inputs.
+#
+# The exporter suites feed generated UV meshes through plush_export.Exporter
+# as plain arrays, the tiler suites feed generated multi-layer Inkscape
+# documents through plush_tiles.Document. Every stage is timed and its peak
+# memory recorded, and the results can be saved as a baseline JSON file and
+# compared against it later, on both the time and the peak of each stage.
+#
+#   plush_benchmark.py [-quick] [-repeat N] [-save FILE] [-baseline FILE] [-threshold RATIO]
+import os
+import sys
+import gc
+import json
+import math
+import random
+import shutil
+import tempfile
+import time
+from io import BytesIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+import numpy
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Stages faster than this, or with a smaller peak than this many bytes, are
+# not checked for regressions.
+NOISE_FLOOR = 0.002
+MEMORY_NOISE_FLOOR = 1 << 20
+
+# Exporter inputs
+def uvGrid(columns, rows, x=0.0, y=0.0, width=1.0, height=1.0, vertexOffset=0):
+    # Quads of a columns x rows grid, as per-loop arrays.
+    i, j = numpy.meshgrid(numpy.arange(columns), numpy.arange(rows), indexing='ij')
+    i = i.ravel()
+    j = j.ravel()
+    cornerI = numpy.column_stack((i, i + 1, i + 1, i)).ravel()
+    cornerJ = numpy.column_stack((j, j, j + 1, j + 1)).ravel()
+    uvs = numpy.column_stack((x + cornerI*width/columns, y + cornerJ*height/rows)).astype(numpy.float32)
+    vertices = vertexOffset + cornerI*(rows + 1) + cornerJ
+    loopStarts = numpy.arange(len(i), dtype=numpy.int32)*4
+    loopTotals = numpy.full(len(i), 4, dtype=numpy.int32)
+    return uvs, loopStarts, loopTotals, vertices
+
+def meshArrays(pieces):
+    # Concatenates (uvs, loopStarts, loopTotals, vertices, group) pieces into
+    # the arrays taken by Exporter.addMesh.
+    uvs = []
+    loopStarts = []
+    loopTotals = []
+    materials = []
+    loopGroups = []
+    loopCount = 0
+    for pieceUvs, pieceStarts, pieceTotals, pieceVertices, group in pieces:
+        uvs.append(pieceUvs)
+        loopStarts.append(pieceStarts + loopCount)
+        loopTotals.append(pieceTotals)
+        materials.append(numpy.full(len(pieceStarts), group % 2, dtype=numpy.int32))
+        loopGroups.append(numpy.full(len(pieceUvs), group, dtype=numpy.int32))
+        loopCount += len(pieceUvs)
+    groupCount = max([piece[4] for piece in pieces]) + 1
+    return (numpy.concatenate(uvs), numpy.concatenate(loopStarts), numpy.concatenate(loopTotals),
+        numpy.concatenate(materials), numpy.concatenate(loopGroups),
+        [(1.0, 0.5, 0.5), (0.5, 0.5, 1.0)], ['Piece%d' % i for i in range(groupCount)])
+
+def singleGrid(size):
+    return meshArrays([uvGrid(size, size) + (0,)])
+
+def manyIslands(count, size):
+    side = int(math.ceil(math.sqrt(count)))
+    cell = 1.0 / side
+    pieces = []
+    for k in range(count):
+        x = (k % side)*cell
+        y = (k // side)*cell
+        pieces.append(uvGrid(size, size, x, y, cell*0.8, cell*0.8, k*(size + 1)**2) + (k,))
+    return meshArrays(pieces)
+
+def jaggedOutline(count):
+    # Triangle fan around the center of a star with count jagged spikes.
+    random.seed(count)
+    angles = numpy.linspace(0.0, 2.0*math.pi, count, endpoint=False)
+    radii = numpy.array([0.3 + 0.15*random.random() for i in range(count)])
+    rim = numpy.column_stack((0.5 + radii*numpy.cos(angles), 0.5 + radii*numpy.sin(angles)))
+    center = numpy.tile([[0.5, 0.5]], (count, 1))
+    uvs = numpy.stack((center, rim, numpy.roll(rim, -1, axis=0)), axis=1).reshape(-1, 2).astype(numpy.float32)
+    vertices = numpy.column_stack((numpy.zeros(count, dtype=numpy.int64), numpy.arange(count) + 1, (numpy.arange(count) + 1) % count + 1)).ravel()
+    loopStarts = numpy.arange(count, dtype=numpy.int32)*3
+    loopTotals = numpy.full(count, 3, dtype=numpy.int32)
+    return meshArrays([(uvs, loopStarts, loopTotals, vertices, 0)])
+
+# Tiler inputs
+def syntheticSvg(layerCount, pathCount, pointCount):
+    # Inkscape document with layerCount layers of pathCount jagged paths.
+    random.seed(layerCount*pathCount + pointCount)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+        '<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="1024" height="1024" version="1.1">']
+    for layer in range(layerCount):
+        lines.append('<g inkscape:groupmode="layer" inkscape:label="Layer%03d"><g>' % layer)
+        for path in range(pathCount):
+            x = random.uniform(0, 800)
+            y = random.uniform(0, 800)
+            commands = ['M %f,%f' % (x, y)]
+            for point in range(pointCount):
+                kind = point % 4
+                if kind == 0:
+                    commands.append('L %f,%f' % (x + random.uniform(0, 200), y + random.uniform(0, 200)))
+                elif kind == 1:
+                    commands.append('l %f,%f' % (random.uniform(-5, 5), random.uniform(-5, 5)))
+                elif kind == 2:
+                    commands.append('c %f,%f %f,%f %f,%f' % tuple([random.uniform(-5, 5) for i in range(6)]))
+                else:
+                    commands.append('Q %f,%f %f,%f' % tuple([random.uniform(0, 200) + offset for offset in (x, y, x, y)]))
+            commands.append('z')
+            lines.append('<path d="%s" stroke="black" fill="#ff8080"/>' % ' '.join(commands))
+        lines.append('<text x="10" y="10">Layer%03d</text></g></g>' % layer)
+    lines.append('</svg>')
+    return '\n'.join(lines).encode('utf-8')
+
+# Suites
+def exporterSuite(name, data):
+    def addMesh(state):
+        state['exporter'] = plush_export.Exporter()
+        state['exporter'].addMesh(*data)
+    def buildMesh(state):
+        exporter = state['exporter']
+        state['mesh'] = exporter.buildMesh(exporter.meshes[0])
+    def extractOutlines(state):
+        state['outlines'] = state['exporter'].extractOutlines(state['mesh'])
+    def extractVertices(state):
+        for outline in state['outlines']:
+            outline.extractVertices()
+    def findInnerTriangles(state):
+        state['exporter'].findInnerTriangles(state['mesh'], state['outlines'])
+    def simplify(state):
+        exporter = state['exporter']
+        for outline in state['outlines']:
+            outline.simplify(0.5, exporter.width, exporter.height)
+    def writeSvg(state):
+        exporter = state['exporter']
+        exporter.outlines = state['outlines']
+        for i in range(len(exporter.outlines)):
+            exporter.outlines[i].name = 'Outline%03d' % i
+        exporter.writeSvg(state['directory'] + '/blueprint.svg')
+
+    return name, [('addMesh', addMesh), ('buildMesh', buildMesh), ('extractOutlines', extractOutlines),
+        ('extractVertices', extractVertices), ('findInnerTriangles', findInnerTriangles),
+        ('simplify', simplify), ('writeSvg', writeSvg)]
+
+def tilerSuite(name, svg):
+    def parse(state):
+        state['tree'] = plush_tiles.etree.parse(BytesIO(svg))
+    def extractPathPositions(state):
+        for path in state['tree'].getroot().iter(plush_tiles.tagName('path', plush_tiles.SVG_NS)):
+            plush_tiles.extractPathPositions(path.attrib['d'])
+    def document(state):
+        state['document'] = plush_tiles.Document(state['tree'])
+    def transformLayers(state):
+        state['document'].transformLayers()
+    def exportLayers(state):
+        state['document'].exportLayers(state['directory'])
+
+    return name, [('parse', parse), ('extractPathPositions', extractPathPositions), ('Document', document),
+        ('transformLayers', transformLayers), ('exportLayers', exportLayers)]
+
+def exporterSuites(quick):
+    scale = 4 if quick else 1
+    return [
+        exporterSuite('export/grid', singleGrid(400 // scale)),
+        exporterSuite('export/islands', manyIslands(400 // scale, 12)),
+        exporterSuite('export/jagged', jaggedOutline(200000 // scale)),
+    ]
+
+def tilerSuites(quick):
+    scale = 4 if quick else 1
+    return [
+        tilerSuite('tiles/layers', syntheticSvg(60 // scale, 20, 200)),
+        tilerSuite('tiles/dense', syntheticSvg(2, 4, 100000 // scale)),
+    ]
+
+def residentBytes():
+    # Current resident set size, from /proc where there is one.
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def forkedPeak(function, state):
+    # Without tracemalloc the stage runs once more in a forked child, whose
+    # maximum resident size starts over, on a copy of the state. Returns how
+    # far the resident size grew above the size at the start.
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            start = residentBytes()
+            function(state)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024 - start
+            os.write(write, str(max(peak, 0)).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 64)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return int(b''.join(chunks) or 0)
+
+def measure(function, state):
+    # Returns the elapsed seconds and the peak memory in bytes.
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        start = timer()
+        function(state)
+        elapsed = timer() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak = forkedPeak(function, state)
+        gc.collect()
+        start = timer()
+        function(state)
+        elapsed = timer() - start
+    return elapsed, peak
+
+def runSuite(suite, repeat):
+    name, stages = suite
+    results = {}
+    directory = tempfile.mkdtemp(prefix='plush_benchmark')
+    try:
+        # The first run records the memory, the timed runs do not trace.
+        for run in range(repeat + 1):
+            state = {'directory': directory}
+            for stage, function in stages:
+                if run == 0:
+                    elapsed, peak = measure(function, state)
+                    results[name + '/' + stage] = {'seconds': elapsed, 'peak': peak}
+                else:
+                    start = timer()
+                    function(state)
+                    elapsed = timer() - start
+                    result = results[name + '/' + stage]
+                    result['seconds'] = elapsed if run == 1 else min(result['seconds'], elapsed)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+class Program:
+    def __init__(self):
+        self.quick = False
+        self.repeat = 3
+        self.saveFileName = None
+        self.baselineFileName = None
+        self.threshold = 1.5
+
+    def parseCommandLine(self):
+        i = 1
+        while i < len(sys.argv):
+            arg = sys.argv[i]
+            if arg == '-quick':
+                self.quick = True
+            elif arg == '-repeat':
+                i += 1
+                self.repeat = int(sys.argv[i])
+            elif arg == '-save':
+                i += 1
+                self.saveFileName = sys.argv[i]
+            elif arg == '-baseline':
+                i += 1
+                self.baselineFileName = sys.argv[i]
+            elif arg == '-threshold':
+                i += 1
+                self.threshold = float(sys.argv[i])
+            else:
+                print('Unknown option %s' % arg)
+                sys.exit(2)
+            i += 1
+
+    def run(self):
+        self.parseCommandLine()
+        suites = []
+        if plush_export is not None:
+            suites += exporterSuites(self.quick)
+        else:
+            print('Skipping the exporter suites: %s' % exportError)
+        if plush_tiles is not None:
+            suites += tilerSuites(self.quick)
+        else:
+            print('Skipping the tiler suites: %s' % tilesError)
+
+        results = {}
+        for suite in suites:
+            results.update(runSuite(suite, self.repeat))
+
+        baseline = {}
+        if self.baselineFileName is not None:
+            with open(self.baselineFileName, 'r') as f:
+                baseline = json.load(f)
+
+        regressions = 0
+        print('%-48s %12s %12s %10s %10s' % ('stage', 'seconds', 'peak KiB', 'time', 'memory'))
+        for key in sorted(results.keys()):
+            result = results[key]
+            timeComparison = ''
+            memoryComparison = ''
+            if key in baseline:
+                ratio = result['seconds'] / max(baseline[key]['seconds'], 1e-9)
+                timeComparison = '%.2fx' % ratio
+                if ratio > self.threshold and result['seconds'] > NOISE_FLOOR:
+                    timeComparison += ' SLOWER'
+                    regressions += 1
+                ratio = float(result['peak']) / max(baseline[key]['peak'], 1)
+                memoryComparison = '%.2fx' % ratio
+                if ratio > self.threshold and result['peak'] > MEMORY_NOISE_FLOOR:
+                    memoryComparison += ' LARGER'
+                    regressions += 1
+            print('%-48s %12.4f %12d %10s %10s' % (key, result['seconds'], result['peak'] // 1024, timeComparison, memoryComparison))
+
+        if self.saveFileName is not None:
+            with open(self.saveFileName, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if regressions > 0:
+            print('%d stage measures above %.2fx the baseline' % (regressions, self.threshold))
+            sys.exit(1)
+
+# plush_tiles is a Python 2 script, so each side only runs where it imports.
+try:
+    import plush_export
+except ImportError as error:
+    plush_export = None
+    exportError = error
+try:
+    import plush_tiles
+except (ImportError, SyntaxError) as error:
+    plush_tiles = None
+    tilesError = error
+
+if __name__ == '__main__':
+    Program().run()
@@ -1,415 +1,945 @@
-import bpy
-import xml.etree.ElementTree as ET
-from mathutils import *
+import hashlib
+import json
+import os
+import time
+import zipfile
+import numpy
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
 from math import *
 
+# Blender is only needed by the operator at the end of this file, the outline
+# pipeline works on plain arrays and can be used outside of it.
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+SVG_URI = 'http://www.w3.org/2000/svg'
+SODIPODI_URI = 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd'
+INKSCAPE_URI = 'http://www.inkscape.org/namespaces/inkscape'
+
 EPSILON = 0.0000001
+
+# Binary outlines written next to the blueprint for plush_tiles.py. The
+# header is followed by the point offsets and name offsets of every outline
+# (uint64, one more than outlines), the fill colors (float64 RGB), the path
+# coordinates in SVG units (float32 or float64 pairs) and the UTF-8 names.
+# Every number is little endian, and digest is the SHA-1 of the SVG file.
+OUTLINES_MAGIC = b'PLUSHOL1'
+OUTLINES_HEADER = numpy.dtype([
+    ('magic', 'S8'),
+    ('digest', 'S40'),
+    ('width', '<f8'),
+    ('height', '<f8'),
+    ('outlineCount', '<u8'),
+    ('pointCount', '<u8'),
+    ('nameBytes', '<u8'),
+    ('coordinateSize', '<u8')])
+
 def closeTo(a, b):
     d = a -b
     return -EPSILON <= d and d <= EPSILON
 
+def cross2(u, v):
+    return u[..., 0]*v[..., 1] - u[..., 1]*v[..., 0]
+
 def polygonWindingNumber(positions):
-    number = 0
-    N = len(positions)
-    for i in range(N):
-        p1 = positions[i]
-        p2 = positions[(i+1) % N]
-        p3 = positions[(i+2) % N]
-        u = p2 - p1
-        v = p3 - p1
-        number +=  u.cross(v)
-    return number
+    u = numpy.roll(positions, -1, axis=0) - positions
+    v = numpy.roll(positions, -2, axis=0) - positions
+    return cross2(u, v).sum()
+
+def fileDigest(filepath):
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
 def colorToHex(color):
-    r = round(color.r*255)
-    g = round(color.g*255)
-    b = round(color.b*255)
+    r = round(color[0]*255)
+    g = round(color[1]*255)
+    b = round(color[2]*255)
     return "#%02X%02X%02X" % (r,g,b)
 
-def pointPolygonWindingNumber(point, positions):
-    number = 0
-    N = len(positions)
-    for i in range(N):
-        p1 = positions[i]
-        p2 = positions[(i+1)% N]
-        u = p1 - point
-        v = p2 - point
-        number +=  u.cross(v)
-    return number
+def fanTriangulate(loopStarts, loopTotals):
+    # Split every polygon into a triangle fan around its first loop.
+    counts = numpy.maximum(loopTotals - 2, 0)
+    polygons = numpy.repeat(numpy.arange(len(counts)), counts)
+    firsts = numpy.cumsum(counts) - counts
+    fan = numpy.arange(len(polygons)) - numpy.repeat(firsts, counts) + 1
+    starts = loopStarts[polygons]
+    triangles = numpy.column_stack((starts, starts + fan, starts + fan + 1))
+    return triangles, polygons
+
+def rangesFor(counts):
+    # Concatenation of arange(count) for every count.
+    return numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+
+def weldExact(uvs):
+    # Merge identical UV coordinates, numbering them by first appearance.
+    unique, first, inverse = numpy.unique(uvs, axis=0, return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    rank = numpy.empty(len(order), dtype=numpy.int64)
+    rank[order] = numpy.arange(len(order))
+    return unique[order], first[order], rank[inverse.reshape(-1)]
+
+def weldPoints(uvs, epsilon=EPSILON):
+    """
+    Merges points closer than epsilon in both coordinates. Taken in order of
+    first appearance, each point joins the earliest kept point close to it,
+    or is kept. Returns the welded positions, the first input index of each
+    of them and the welded index of every input point.
+    """
+    positions, first, inverse = weldExact(uvs)
+    if epsilon <= 0 or len(positions) < 2:
+        return positions, first, inverse
+
+    # Bucket the points in cells at least epsilon wide, so that close points
+    # are always in neighbouring cells.
+    low = positions.min(axis=0)
+    cellSize = max(epsilon, (positions.max(axis=0) - low).max() / 2**30)
+    cells = numpy.floor((positions - low) / cellSize).astype(numpy.int64) + 1
+    rowSize = cells[:, 1].max() + 2
+    keys = cells[:, 0]*rowSize + cells[:, 1]
+    order = numpy.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+
+    # Pair every point with the earlier points close to it.
+    points = []
+    neighbours = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbourKeys = keys + dx*rowSize + dy
+            starts = numpy.searchsorted(sortedKeys, neighbourKeys, side='left')
+            counts = numpy.searchsorted(sortedKeys, neighbourKeys, side='right') - starts
+            points.append(numpy.repeat(numpy.arange(len(keys)), counts))
+            neighbours.append(order[numpy.repeat(starts, counts) + rangesFor(counts)])
+    points = numpy.concatenate(points)
+    neighbours = numpy.concatenate(neighbours)
+    delta = numpy.abs(positions[points] - positions[neighbours])
+    close = (neighbours < points) & (delta[:, 0] <= epsilon) & (delta[:, 1] <= epsilon)
+    points, neighbours = points[close], neighbours[close]
+
+    # Settle the points with earlier close points in one ordered pass, each
+    # going to its earliest close kept point. Every other point is kept.
+    order = numpy.lexsort((neighbours, points))
+    points, neighbours = points[order].tolist(), neighbours[order].tolist()
+    kept = [True]*len(positions)
+    targets = list(range(len(positions)))
+    previous = -1
+    for point, neighbour in zip(points, neighbours):
+        if point == previous:
+            continue
+        if kept[neighbour]:
+            kept[point] = False
+            targets[point] = neighbour
+            previous = point
+
+    kept = numpy.flatnonzero(kept)
+    rank = numpy.empty(len(positions), dtype=numpy.int64)
+    rank[kept] = numpy.arange(len(kept))
+    return positions[kept], first[kept], rank[numpy.array(targets, dtype=numpy.int64)][inverse]
+
+def segmentDistances(points, start, end):
+    direction = end - start
+    length2 = direction.dot(direction)
+    if length2 <= 0:
+        return numpy.sqrt(((points - start)**2).sum(axis=1))
+    t = numpy.clip((points - start).dot(direction) / length2, 0.0, 1.0)
+    closest = start + t[:, numpy.newaxis]*direction
+    return numpy.sqrt(((points - closest)**2).sum(axis=1))
+
+def douglasPeucker(points, tolerance):
+    # Mask of the points of an open polyline kept by Douglas-Peucker.
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while len(stack) > 0:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = segmentDistances(points[first + 1:last], points[first], points[last])
+        farthest = distances.argmax()
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+def collinearPoints(points):
+    # Mask of the points of a closed polygon lying on the straight line
+    # between their neighbours.
+    u = points - numpy.roll(points, 1, axis=0)
+    v = numpy.roll(points, -1, axis=0) - points
+    lengths = numpy.sqrt((u**2).sum(axis=1)*(v**2).sum(axis=1))
+    sines = numpy.abs(cross2(u, v)) / numpy.where(lengths > 0, lengths, 1.0)
+    return (sines <= EPSILON) & ((u*v).sum(axis=1) > 0)
+
+def simplifyPolygon(points, tolerance):
+    """
+    Mask of the points of a closed polygon kept after merging collinear
+    points and running Douglas-Peucker with the given tolerance.
+    """
+    keep = ~collinearPoints(points)
+    if keep.sum() < 3:
+        return numpy.ones(len(points), dtype=bool)
+    indices = numpy.flatnonzero(keep)
+    remaining = points[indices]
+
+    # Split the loop at the first point and the point farthest from it.
+    farthest = ((remaining - remaining[0])**2).sum(axis=1).argmax()
+    closed = numpy.concatenate((remaining, remaining[:1]))
+    kept = numpy.zeros(len(remaining), dtype=bool)
+    kept[:farthest + 1] |= douglasPeucker(closed[:farthest + 1], tolerance)
+    kept[farthest:] |= douglasPeucker(closed[farthest:], tolerance)[:-1]
+    if kept.sum() < 3:
+        return numpy.ones(len(points), dtype=bool)
 
-def pointInsidePolygon(point, polygon):
-    return not closeTo(pointPolygonWindingNumber(point, polygon), 0.0)
+    keep[indices[~kept]] = False
+    return keep
+
+class OutlineIndex:
+    """
+    Point in polygon queries over a set of outlines. The edges of every
+    outline are bucketed into horizontal slabs of its bounding box, so an
+    even-odd crossing test only visits the edges that span the query height.
+    """
+    def __init__(self, polygons):
+        counts = numpy.array([len(polygon) for polygon in polygons], dtype=numpy.int64)
+        edgeOutlines = numpy.repeat(numpy.arange(len(polygons)), counts)
+        self.starts = numpy.concatenate(polygons)
+        self.ends = numpy.concatenate([numpy.roll(polygon, -1, axis=0) for polygon in polygons])
+
+        # Aim for one slab per edge, but use fewer slabs on outlines with long
+        # edges so that every edge only lands in a few of them.
+        self.minY = numpy.array([polygon[:, 1].min() for polygon in polygons])
+        extents = numpy.array([polygon[:, 1].max() for polygon in polygons]) - self.minY
+        edgeSpans = numpy.bincount(edgeOutlines, weights=numpy.abs(self.ends[:, 1] - self.starts[:, 1]), minlength=len(polygons))
+        relativeSpans = edgeSpans / numpy.where(extents > 0, extents, 1.0)
+        self.slabCounts = numpy.clip((2*counts / numpy.maximum(relativeSpans, 1.0)).astype(numpy.int64), 1, counts)
+        self.slabHeights = extents / self.slabCounts
+        self.slabHeights[self.slabHeights <= 0] = 1.0
+        self.slabOffsets = numpy.cumsum(self.slabCounts) - self.slabCounts
+
+        low = self.slabsFor(edgeOutlines, numpy.minimum(self.starts[:, 1], self.ends[:, 1]))
+        high = self.slabsFor(edgeOutlines, numpy.maximum(self.starts[:, 1], self.ends[:, 1]))
+        spans = high - low + 1
+        bucketEdges = numpy.repeat(numpy.arange(len(edgeOutlines)), spans)
+        buckets = numpy.repeat(self.slabOffsets[edgeOutlines] + low - 1, spans) + rangesFor(spans) + 1
+        order = numpy.argsort(buckets, kind='stable')
+        self.bucketEdges = bucketEdges[order]
+        bucketSizes = numpy.bincount(buckets, minlength=int(self.slabCounts.sum()))
+        self.bucketStarts = numpy.cumsum(bucketSizes) - bucketSizes
+        self.bucketSizes = bucketSizes
+
+    def slabsFor(self, outlines, y):
+        slabs = numpy.floor((y - self.minY[outlines]) / self.slabHeights[outlines]).astype(numpy.int64)
+        return numpy.clip(slabs, 0, self.slabCounts[outlines] - 1)
+
+    def contains(self, outlines, points):
+        buckets = self.slabOffsets[outlines] + self.slabsFor(outlines, points[:, 1])
+        sizes = self.bucketSizes[buckets]
+        queries = numpy.repeat(numpy.arange(len(points)), sizes)
+        edges = self.bucketEdges[numpy.repeat(self.bucketStarts[buckets], sizes) + rangesFor(sizes)]
+
+        x, y = points[queries, 0], points[queries, 1]
+        p1 = self.starts[edges]
+        p2 = self.ends[edges]
+        spans = (p1[:, 1] > y) != (p2[:, 1] > y)
+        dy = numpy.where(spans, p2[:, 1] - p1[:, 1], 1.0)
+        crossings = spans & (x < p1[:, 0] + (y - p1[:, 1])*(p2[:, 0] - p1[:, 0])/dy)
+        return numpy.bincount(queries, weights=crossings, minlength=len(points)).astype(numpy.int64) % 2 == 1
 
 class Outline:
-    def __init__(self, root):
-        self.root = root
+    def __init__(self, mesh=None, edges=None, vertices=None):
+        self.mesh = mesh
+        self.edges = edges
+        self.vertices = vertices
         self.innerTriangle = None
         self.innerVertex = None
-        self.color = Color((1.0, 1.0, 1.0))
+        self.color = (1.0, 1.0, 1.0)
+        self.groupName = None
+
+    @classmethod
+    def fromPoints(cls, points, color, groupName):
+        outline = cls()
+        outline.setPoints(points)
+        outline.color = color
+        outline.groupName = groupName
+        return outline
         
     def extractVertices(self):
-        self.vertices = []
-        self.edges = []
-        current = self.root
-        self.edges.append(current)
-        self.vertices.append(current.v1)
-        
-        current = current.next
-        while current != self.root:
-            self.edges.append(current)
-            self.vertices.append(current.v1)
-            current = current.next
-            
         # Set the outline flag
-        for vertex in self.vertices:
-            vertex.isOutline = True
-        
-        self.positions = list(map(lambda x: x.position, self.vertices))
-        
-        # Compute the centroid
-        self.centroid = self.positions[0].copy()
-        for i in range(len(self.positions)):
-            self.centroid += self.positions[i]
-        self.centroid /= len(self.positions)
+        self.mesh.outlineVertices[self.vertices] = True
+        self.setPoints(self.mesh.positions[self.vertices])
+
+    def setPoints(self, points):
+        self.points = points
+        self.pathPoints = points
+        self.positions = points
         
-        # Compute the bounding box
-        self.max = self.positions[0].copy()
-        self.min = self.positions[0].copy()
-        for position in self.positions:
-            self.max[0] = max(self.max[0], position[0])
-            self.max[1] = max(self.max[1], position[1])
-            self.min[0] = min(self.min[0], position[0])
-            self.min[1] = min(self.min[1], position[1])
+        # Compute the centroid and the bounding box
+        self.centroid = self.positions.mean(axis=0)
+        self.max = self.positions.max(axis=0)
+        self.min = self.positions.min(axis=0)
         self.center = (self.max + self.min)*0.5
         
         winding = polygonWindingNumber(self.positions)
         if winding < 0:
-            self.positions.reverse()
-
-    def findInnerTriangle(self, allTriangles):
-        for edge in self.edges:
-            for triangle in edge.triangles:
-                for vertex in triangle.getVertices():
-                    if vertex.isOutline: continue
-                    if vertex == edge.v1: continue
-                    if vertex == edge.v2: continue
-                    if pointInsidePolygon(vertex.position, self.positions):
-                        self.innerTriangle = triangle
-                        self.innerVertex = vertex
-                        return
-    
+            self.positions = self.positions[::-1]
+
+    def simplify(self, tolerance, width, height):
+        self.pathPoints = self.points[simplifyPolygon(self.points*(width, height), tolerance)]
+
     def makePathData(self, width, height):
-        result = "M %s" % (self.vectorToString(self.vertices[0].position, width, height))
-        for i in range(1, len(self.vertices)):
-            result += " L %s" % (self.vectorToString(self.vertices[i].position, width, height))
-        result += " Z"
-        return result
+        positions = self.pathPoints
+        xs = (positions[:, 0]*width).tolist()
+        ys = ((1.0 - positions[:, 1])*height).tolist()
+        return "M " + " L ".join(["%f %f" % vector for vector in zip(xs, ys)]) + " Z"
         
-    def vectorToString(self, vector, width, height):
-        return "%f %f" % (vector[0]*width, (1.0 - vector[1])*height)
-
     def centerFor(self, width, height):
         return (self.center[0]*width, (1.0 - self.center[1])*height)
     
     def centroidFor(self, width, height):
         return (self.centroid[0]*width, (1.0 - self.centroid[1])*height)
         
-    def extractMetadata(self):
+    def extractMetadata(self, colors, groupNames):
         face = self.innerTriangle
         if face is not None:
-            object = face.object
-            mesh = object.data
-            blenderFace = face.face
             # Use the material for setting the fill color.
-            if len(mesh.materials) > 0:
-                material = mesh.materials[blenderFace.material_index]
-                self.color = material.diffuse_color
+            material = self.mesh.faceMaterials[face]
+            if material >= 0:
+                self.color = colors[material]
                 
             if self.innerVertex is not None:
-                blenderVertex = mesh.vertices[self.innerVertex.blenderIndex]
-                vgroups = blenderVertex.groups
-                if len(vgroups) > 0:
-                    vgroup = object.vertex_groups[vgroups[0].group]
-                    self.name = vgroup.name
-
-class Vertex:
-    def __init__(self, blenderIndex, index, position):
-        self.blenderIndex = blenderIndex
-        self.index = index
-        self.position = position
-        self.isOutline = False
-
-class Edge:
-    def __init__(self, v1, v2):
-        self.v1 = v1
-        self.v2 = v2
-        self.triangles = []
-        self.connections = []
-        self.prev = None
-        self.next = None
-        self.visited = False
-        
-    def isOutline(self):
-        return len(self.triangles) < 2
-        
-    def addTriangle(self, newTriangle):
-        assert len(self.triangles) < 2
-        self.triangles.append(newTriangle)
-        
-class Triangle:
-    def __init__(self, object, face, v1, v2, v3, e1, e2, e3):
-        self.object = object
-        self.face = face
-        self.v1 = v1
-        self.v2 = v2
-        self.v3 = v3
-        self.e1 = e1
-        self.e2 = e2
-        self.e3 = e3
-         
-    def getVertices(self):
-        return (self.v1, self.v2, self.v3)
-    
+                group = self.mesh.vertexGroups[self.innerVertex]
+                if group >= 0:
+                    self.groupName = groupNames[group]
+
+class HalfEdgeMesh:
+    """
+    Struct-of-arrays triangle mesh. Half-edge 3*f + k goes from triangles[f, k]
+    to triangles[f, (k+1) % 3]. Half-edges sharing the same undirected edge are
+    paired through halfEdgeMates, which is -1 for outline half-edges.
+    """
+    def __init__(self, positions, vertexGroups, triangles, faceMaterials):
+        self.positions = positions
+        self.vertexGroups = vertexGroups
+        self.outlineVertices = numpy.zeros(len(positions), dtype=bool)
+        self.triangles = triangles
+        self.corners = triangles.reshape(-1)
+        self.faceMaterials = faceMaterials
+        self.buildEdges()
+
+    def nextHalfEdges(self, halfEdges):
+        return halfEdges - halfEdges % 3 + (halfEdges + 1) % 3
+
+    def prevHalfEdges(self, halfEdges):
+        return halfEdges - halfEdges % 3 + (halfEdges + 2) % 3
+
+    def halfEdgeVertices(self, halfEdges):
+        return self.corners[halfEdges], self.corners[self.nextHalfEdges(halfEdges)]
+
+    def buildEdges(self):
+        halfEdges = numpy.arange(len(self.corners))
+        origins, targets = self.halfEdgeVertices(halfEdges)
+        assert numpy.all(origins != targets)
+
+        # Sort the canonical (min, max) keys so that half-edges of the same
+        # edge become neighbours.
+        keys = numpy.minimum(origins, targets).astype(numpy.int64)*len(self.positions) + numpy.maximum(origins, targets)
+        order = numpy.argsort(keys, kind='stable')
+        sortedKeys = keys[order]
+        firsts = numpy.ones(len(order), dtype=bool)
+        firsts[1:] = sortedKeys[1:] != sortedKeys[:-1]
+        groupStarts = numpy.flatnonzero(firsts)
+        groupCounts = numpy.diff(numpy.append(groupStarts, len(order)))
+        sortedEdges = numpy.cumsum(firsts) - 1
+
+        self.halfEdgeEdges = numpy.empty(len(order), dtype=numpy.int32)
+        self.halfEdgeEdges[order] = sortedEdges
+        self.edgeVertices = numpy.column_stack((origins[order[groupStarts]], targets[order[groupStarts]]))
+
+        # Pair consecutive half-edges of every edge. A half-edge left without
+        # a mate lies on an outline.
+        ranks = numpy.arange(len(order)) - groupStarts[sortedEdges]
+        mateRanks = ranks ^ 1
+        hasMate = mateRanks < groupCounts[sortedEdges]
+        self.halfEdgeMates = numpy.full(len(order), -1, dtype=numpy.int32)
+        self.halfEdgeMates[order[hasMate]] = order[(groupStarts[sortedEdges] + mateRanks)[hasMate]]
+
+    def outlineHalfEdges(self):
+        return numpy.flatnonzero(self.halfEdgeMates < 0)
+
+    def outlineNeighbours(self, halfEdges, vertices):
+        # Walk the triangle fan around each vertex, starting on an outline
+        # half-edge, until the next outline half-edge is reached. This pairs
+        # the outline half-edges even when more than two of them meet at a
+        # non-manifold vertex.
+        neighbours = numpy.full(len(halfEdges), -1, dtype=numpy.int32)
+        current = halfEdges.copy()
+        pending = numpy.arange(len(halfEdges))
+        for i in range(len(self.corners) + 1):
+            if len(pending) == 0:
+                return neighbours
+            halfEdge = current[pending]
+            atOrigin = self.corners[halfEdge] == vertices[pending]
+            other = numpy.where(atOrigin, self.prevHalfEdges(halfEdge), self.nextHalfEdges(halfEdge))
+            mates = self.halfEdgeMates[other]
+            done = mates < 0
+            neighbours[pending[done]] = other[done]
+            current[pending[~done]] = mates[~done]
+            pending = pending[~done]
+        assert False
+
+    def outlineLoops(self):
+        outlineEdges = self.outlineHalfEdges()
+        origins, targets = self.halfEdgeVertices(outlineEdges)
+        outlineIndices = numpy.full(len(self.corners), -1, dtype=numpy.int64)
+        outlineIndices[outlineEdges] = numpy.arange(len(outlineEdges))
+
+        # Next-edge lookup table over (edge, direction) states. State 2*i + 1
+        # leaves outline edge i through its target, state 2*i through its origin.
+        nextStates = numpy.empty(len(outlineEdges)*2, dtype=numpy.int64)
+        for forward, exits in ((1, targets), (0, origins)):
+            neighbours = self.outlineNeighbours(outlineEdges, exits)
+            neighbourForward = self.corners[neighbours] == exits
+            nextStates[forward::2] = outlineIndices[neighbours]*2 + neighbourForward
+        entries = numpy.empty(len(outlineEdges)*2, dtype=numpy.int32)
+        entries[1::2] = origins
+        entries[0::2] = targets
+
+        # Chain every loop in a single pass over the table.
+        nextStates = nextStates.tolist()
+        visited = bytearray(len(outlineEdges))
+        loops = []
+        for start in range(len(outlineEdges)):
+            if visited[start]: continue
+            first = state = start*2 + 1
+            states = []
+            while True:
+                visited[state >> 1] = 1
+                states.append(state)
+                state = nextStates[state]
+                if state == first:
+                    break
+            states = numpy.array(states)
+            loops.append((outlineEdges[states >> 1], entries[states]))
+        return loops
+
+class SvgWriter:
+    """
+    Writes SVG markup straight to a binary file as the elements are emitted,
+    without building a document tree in memory.
+    """
+    ATTRIBUTE_ENTITIES = {'"': '&quot;', '\n': '&#10;'}
+
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, text):
+        self.out.write(text.encode('utf-8'))
+
+    def header(self):
+        self.out.write(b'<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
+
+    def startTag(self, tag, attributes):
+        return '<' + tag + ''.join([' %s="%s"' % (name, escape(value, self.ATTRIBUTE_ENTITIES)) for name, value in attributes])
+
+    def begin(self, tag, attributes=()):
+        self.write(self.startTag(tag, attributes) + '>')
+
+    def end(self, tag):
+        self.write('</%s>' % tag)
+
+    def element(self, tag, attributes=()):
+        self.write(self.startTag(tag, attributes) + ' />')
+
+    def text(self, text, attributes=()):
+        self.write(self.startTag('text', attributes) + '>' + escape(text) + '</text>')
+
+class Statistics:
+    """
+    Wall time and call count of every pipeline stage, plus element counters.
+    """
+    timer = getattr(time, 'perf_counter', time.time)
+
+    def __init__(self):
+        self.stages = {}
+        self.stageOrder = []
+        self.counters = {}
+        self.counterOrder = []
+
+    @contextmanager
+    def stage(self, name):
+        start = self.timer()
+        try:
+            yield
+        finally:
+            self.addTime(name, self.timer() - start)
+
+    def addTime(self, name, seconds):
+        if name not in self.stages:
+            self.stages[name] = [0.0, 0]
+            self.stageOrder.append(name)
+        stage = self.stages[name]
+        stage[0] += seconds
+        stage[1] += 1
+
+    def count(self, name, amount=1):
+        if name not in self.counters:
+            self.counters[name] = 0
+            self.counterOrder.append(name)
+        self.counters[name] += amount
+
+    def summary(self):
+        lines = ['%-24s %8s %10s' % ('stage', 'calls', 'seconds')]
+        for name in self.stageOrder:
+            seconds, calls = self.stages[name]
+            lines.append('%-24s %8d %10.4f' % (name, calls, seconds))
+        for name in self.counterOrder:
+            lines.append('%-24s %19d' % (name, self.counters[name]))
+        return '\n'.join(lines)
+
+    def toJson(self):
+        return {
+            'stages': dict([(name, {'seconds': seconds, 'calls': calls}) for name, (seconds, calls) in self.stages.items()]),
+            'counters': dict(self.counters),
+        }
+
+    def dump(self, fileName):
+        with open(fileName, 'w') as f:
+            json.dump(self.toJson(), f, indent=2, sort_keys=True)
+
+class MeshData:
+    """
+    Triangulated input mesh of a single object, as given to Exporter.addMesh.
+    The digest covers every array and table of the mesh.
+    """
+    def __init__(self, uvs, loopGroups, triangles, materials, colors, groupNames, digest):
+        self.uvs = uvs
+        self.loopGroups = loopGroups
+        self.triangles = triangles
+        self.materials = materials
+        self.colors = colors
+        self.groupNames = groupNames
+        self.digest = digest
+
 class Exporter:
     def __init__(self):
         self.outlines = []
-        self.vertices = {}
-        self.edges = {}
-        self.triangles = []
-        self.outline_edges = {}
+        self.meshes = []
+        self.weldEpsilon = EPSILON
+        self.simplifyTolerance = 0.0
+        self.cachePath = None
+        self.outlinesPath = None
+        self.outlinesType = numpy.float64
+        self.statistics = Statistics()
+        self.printStatistics = False
         self.width = 1024
         self.height = 1024
         
-    def getVertex(self, vec, index):
-        coordinates = (vec.x, vec.y)
-        vertex = self.vertices.get(coordinates, None)
-        if vertex != None: return vertex
-        
-        vertex = Vertex(index, len(self.vertices), vec)
-        self.vertices[coordinates] = vertex
-        return vertex
-        
-    def addEdge(self, p1, p2):
-        assert p1 != p2
-        i1 = min(p1.index, p2.index)
-        i2 = max(p1.index, p2.index)
-        assert i1 != i2
-        if (i1, i2) in self.edges:
-            return self.edges[(i1, i2)]
-        
-        edge = Edge(p1, p2)
-        self.edges[(i1,i2)] = edge
-        return edge
-        
-    def addTriangle(self, object, face, p1, p2, p3):
-        e1 = self.addEdge(p1, p2)
-        e2 = self.addEdge(p2, p3)
-        e3 = self.addEdge(p3, p1)
-        t = Triangle(object, face, p1, p2, p3, e1, e2, e3)
-        e1.addTriangle(t)
-        e2.addTriangle(t)
-        e3.addTriangle(t)
-        self.triangles.append(t)
-        
-    def addObject(self, object):
-        # Only support mesh objects
-        if object.type != 'MESH':
-            return
-        mesh = object.data
-        mesh.update(calc_tessface=True)
-        faces = mesh.tessfaces
-        uvmap_layer = mesh.tessface_uv_textures.active
-        uv_faces = uvmap_layer.data
-        
-        for face in faces:
-            uvface = uv_faces[face.index]
-            if len(face.vertices) == 3:
-                p1 = self.getVertex(uvface.uv1, face.vertices[0])
-                p2 = self.getVertex(uvface.uv2, face.vertices[1])
-                p3 = self.getVertex(uvface.uv3, face.vertices[2])
-                self.addTriangle(object, face, p1, p2, p3)
-            else:
-                p1 = self.getVertex(uvface.uv1, face.vertices[0])
-                p2 = self.getVertex(uvface.uv2, face.vertices[1])
-                p3 = self.getVertex(uvface.uv3, face.vertices[2])
-                p4 = self.getVertex(uvface.uv4, face.vertices[3])
-                self.addTriangle(object, face, p1, p2, p3)
-                self.addTriangle(object, face, p3, p4, p1)
-                
-    def extractOutlines(self):
-        self.outline_edge_list = []
-        for edge in self.edges.values():
-            if edge.isOutline():
-                self.outline_edge_list.append(edge)
-                p1Edges = self.outline_edges.get(edge.v1, [])
-                p2Edges = self.outline_edges.get(edge.v2, [])
-                
-                assert len(p1Edges) < 2
-                assert len(p2Edges) < 2
-                for newEdge in p1Edges:
-                    edge.connections.append(newEdge)
-                    newEdge.connections.append(edge)
-                    
-                for newEdge in p2Edges:
-                    edge.connections.append(newEdge)
-                    newEdge.connections.append(edge)
-                
-                p1Edges.append(edge)
-                p2Edges.append(edge)
-                self.outline_edges[edge.v1] = p1Edges
-                self.outline_edges[edge.v2] = p2Edges
+    def addMesh(self, uvs, loopStarts, loopTotals, materials, loopGroups, colors=(), groupNames=()):
+        """
+        Adds a mesh given as plain arrays: the UV coordinate and vertex group
+        of every loop, the first loop and loop count of every polygon, and the
+        material index of every polygon. Material indices refer to colors and
+        vertex groups to groupNames, with -1 meaning none.
+        """
+        with self.statistics.stage('addMesh'):
+            uvs = numpy.asarray(uvs).reshape(-1, 2)
+            loopStarts = numpy.asarray(loopStarts)
+            loopTotals = numpy.asarray(loopTotals)
+            materials = numpy.asarray(materials)
+            loopGroups = numpy.asarray(loopGroups)
+            colors = [tuple(color)[:3] for color in colors]
+            groupNames = list(groupNames)
 
-    def fixOutlineOrder(self, edge):
-        if edge.visited: return
-        
-        outline = Outline(edge)
-        self.outlines.append(outline)
-        prev = None
-        current = edge
-        count = 1
-        first = True
-        while first or current != edge:
-            current.visited = True
-            first = False
-            assert len(current.connections) <= 2
-            next = None
-            for node in current.connections:
-                if node != prev:
-                    next = node
-                    
-            # Set current and next links
-            current.next = next
-            next.prev = current
-            
-            # Advance
-            prev = current
-            current = next
-            count += 1
-            
-    def fixOutlineOrders(self):
-        for edge in self.outline_edge_list:
-            self.fixOutlineOrder(edge)
+            digest = hashlib.sha1()
+            for data in (uvs, loopStarts, loopTotals, materials, loopGroups):
+                digest.update(numpy.ascontiguousarray(data).tobytes())
+            digest.update(repr((colors, groupNames)).encode('utf-8'))
+
+            triangles, polygons = fanTriangulate(loopStarts, loopTotals)
+            self.meshes.append(MeshData(uvs, loopGroups, triangles, materials[polygons], colors, groupNames, digest.hexdigest()))
+            self.statistics.count('loops', len(uvs))
+            self.statistics.count('triangles', len(triangles))
+
+    def buildMesh(self, meshData):
+        # Weld the UV corners into a vertex table.
+        with self.statistics.stage('weld'):
+            positions, firstLoops, loopToVertex = weldPoints(meshData.uvs.astype(numpy.float64), self.weldEpsilon)
+        corners = loopToVertex[meshData.triangles]
+
+        # Drop the triangles that collapsed when welding.
+        valid = (corners[:, 0] != corners[:, 1]) & (corners[:, 1] != corners[:, 2]) & (corners[:, 2] != corners[:, 0])
+        materials = meshData.materials[valid]
+        materials = numpy.where((materials >= 0) & (materials < len(meshData.colors)), materials, -1)
+        groups = meshData.loopGroups[firstLoops]
+        groups = numpy.where((groups >= 0) & (groups < len(meshData.groupNames)), groups, -1)
+
+        with self.statistics.stage('buildEdges'):
+            mesh = HalfEdgeMesh(positions,
+                groups.astype(numpy.int32),
+                corners[valid].astype(numpy.int32),
+                materials.astype(numpy.int32))
+        self.statistics.count('vertices', len(mesh.positions))
+        self.statistics.count('edges', len(mesh.edgeVertices))
+        return mesh
+
+    def extractOutlines(self, mesh):
+        return [Outline(mesh, edges, vertices) for edges, vertices in mesh.outlineLoops()]
             
+    def findInnerTriangles(self, mesh, outlines):
+        if len(outlines) == 0:
+            return
+        index = OutlineIndex([outline.positions for outline in outlines])
+
+        # Every vertex of the triangles along an outline is a candidate, in
+        # outline edge order.
+        edges = numpy.concatenate([outline.edges for outline in outlines])
+        edgeOutlines = numpy.repeat(numpy.arange(len(outlines)), [len(outline.edges) for outline in outlines])
+        triangles = numpy.repeat(edges // 3, 3)
+        candidateOutlines = numpy.repeat(edgeOutlines, 3)
+        vertices = mesh.triangles[edges // 3].reshape(-1)
+        candidates = ~mesh.outlineVertices[vertices]
+        triangles, candidateOutlines, vertices = triangles[candidates], candidateOutlines[candidates], vertices[candidates]
+
+        # Test each vertex once per outline.
+        keys = candidateOutlines.astype(numpy.int64)*len(mesh.positions) + vertices
+        first = numpy.sort(numpy.unique(keys, return_index=True)[1])
+        triangles, candidateOutlines, vertices = triangles[first], candidateOutlines[first], vertices[first]
+
+        inside = index.contains(candidateOutlines, mesh.positions[vertices])
+        triangles, candidateOutlines, vertices = triangles[inside], candidateOutlines[inside], vertices[inside]
+        found, first = numpy.unique(candidateOutlines, return_index=True)
+        for outlineIndex, candidate in zip(found.tolist(), first.tolist()):
+            outline = outlines[outlineIndex]
+            outline.innerTriangle = triangles[candidate]
+            outline.innerVertex = vertices[candidate]
+
+    def buildMeshOutlines(self, meshData):
+        mesh = self.buildMesh(meshData)
+        with self.statistics.stage('extractOutlines'):
+            outlines = self.extractOutlines(mesh)
+        with self.statistics.stage('extractVertices'):
+            for outline in outlines:
+                outline.extractVertices()
+        with self.statistics.stage('findInnerTriangles'):
+            self.findInnerTriangles(mesh, outlines)
+        with self.statistics.stage('extractMetadata'):
+            for outline in outlines:
+                outline.extractMetadata(meshData.colors, meshData.groupNames)
+        return outlines
+
+    def cacheKey(self, meshData):
+        return hashlib.sha1(('%s %r' % (meshData.digest, self.weldEpsilon)).encode('utf-8')).hexdigest()
+
+    def loadCache(self):
+        # Maps a cache key to the (points, color, groupName) of every outline.
+        cache = {}
+        if self.cachePath is None or not os.path.exists(self.cachePath):
+            return cache
+        try:
+            with numpy.load(self.cachePath, allow_pickle=False) as data:
+                for name in data.files:
+                    if not name.endswith('_counts'):
+                        continue
+                    key = name[:-len('_counts')]
+                    counts = data[key + '_counts']
+                    points = numpy.split(data[key + '_points'], numpy.cumsum(counts)[:-1])
+                    colors = data[key + '_colors'].tolist()
+                    groupNames = [str(groupName) if len(groupName) > 0 else None for groupName in data[key + '_names']]
+                    cache[key] = [(points[i], tuple(colors[i]), groupNames[i]) for i in range(len(counts))]
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+            print('Ignoring unreadable outline cache %s' % self.cachePath)
+            return {}
+        return cache
+
+    def saveCache(self, entries):
+        if self.cachePath is None:
+            return
+        arrays = {}
+        for key, entry in entries.items():
+            arrays[key + '_points'] = numpy.concatenate([points for points, color, groupName in entry] + [numpy.empty((0, 2))])
+            arrays[key + '_counts'] = numpy.array([len(points) for points, color, groupName in entry], dtype=numpy.int64)
+            arrays[key + '_colors'] = numpy.array([color for points, color, groupName in entry], dtype=numpy.float64).reshape(-1, 3)
+            arrays[key + '_names'] = numpy.array([groupName or '' for points, color, groupName in entry], dtype=str)
+        with open(self.cachePath, 'wb') as f:
+            numpy.savez(f, **arrays)
+
     def buildOutlines(self):
-        self.extractOutlines()
-        self.fixOutlineOrders()
+        # Only the meshes that changed since the cache was written are rebuilt.
+        with self.statistics.stage('loadCache'):
+            cache = self.loadCache()
+        entries = {}
+        for meshData in self.meshes:
+            key = self.cacheKey(meshData)
+            entry = entries.get(key, cache.get(key))
+            if entry is None:
+                outlines = self.buildMeshOutlines(meshData)
+                entry = [(outline.points, outline.color, outline.groupName) for outline in outlines]
+                self.statistics.count('built meshes')
+            else:
+                outlines = [Outline.fromPoints(*item) for item in entry]
+                self.statistics.count('cached meshes')
+            entries[key] = entry
+            self.outlines += outlines
+        with self.statistics.stage('saveCache'):
+            self.saveCache(entries)
+        self.statistics.count('outlines', len(self.outlines))
+
         for i in range(len(self.outlines)):
             outline = self.outlines[i]
-            outline.name = 'Outline%03d' % i
-            outline.extractVertices()
-            outline.findInnerTriangle(self.triangles)
-            outline.extractMetadata()
+            if outline.groupName is not None:
+                outline.name = outline.groupName
+            else:
+                outline.name = 'Outline%03d' % i
         self.outlines.sort(key=lambda x: x.name)
     
-    def exportOutlineName(self, outline, layer, group):
+    def exportOutlineName(self, outline, writer):
         x, y = outline.centerFor(self.width, self.height)
-        text = ET.SubElement(group, 'text')
-        text.attrib['fill'] = 'black'
-        text.attrib['x'] = str(x)
-        text.attrib['y'] = str(y)
-        text.text = outline.name
+        writer.text(outline.name, (('fill', 'black'), ('x', str(x)), ('y', str(y))))
     
-    def exportOutline(self, outline, parent):
-        layer = ET.SubElement(parent, 'g')
-        layer.attrib['inkscape:groupmode'] = 'layer'
-        layer.attrib['inkscape:label'] = outline.name
-        group = ET.SubElement(layer, 'g')
-        
-        path = ET.SubElement(group, 'path')
-        path.attrib['d'] = outline.makePathData(self.width, self.height)
-        path.attrib['stroke'] = 'black'
-        path.attrib['fill'] = colorToHex(outline.color)
-        
-        self.exportOutlineName(outline, layer, group)
+    def exportOutline(self, outline, writer):
+        writer.begin('g', (('inkscape:groupmode', 'layer'), ('inkscape:label', outline.name)))
+        writer.begin('g')
+        writer.element('path', (
+            ('d', outline.makePathData(self.width, self.height)),
+            ('stroke', 'black'),
+            ('fill', colorToHex(outline.color))))
+        self.exportOutlineName(outline, writer)
+        writer.end('g')
+        writer.end('g')
             
-    def buildXml(self):
-        svg_uri="http://www.w3.org/2000/svg"
-        sodipodi_uri = 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd'
-        inkscape_uri = 'http://www.inkscape.org/namespaces/inkscape'
-        ET.register_namespace('svg', svg_uri)
-        ET.register_namespace('sodipodi', sodipodi_uri)
-        ET.register_namespace('inkscape', inkscape_uri)
-        self.outlineIndex = 0
-        
-        document = ET.Element('svg')
-        document.attrib['xmlns:svg'] = svg_uri
-        document.attrib['xmlns'] = svg_uri
-        document.attrib['xmlns:sodipodi'] = sodipodi_uri
-        document.attrib['xmlns:inkscape'] = inkscape_uri
-        document.attrib['width'] = str(self.width)
-        document.attrib['height'] = str(self.height)
-        document.attrib['version'] = '1.1'
-        
-        
+    def simplifyOutlines(self):
         for outline in self.outlines:
-            self.exportOutline(outline, document)
-        return document
-    
+            outline.simplify(self.simplifyTolerance, self.width, self.height)
+
+    def writeSvg(self, filepath):
+        # Returns the number of bytes written.
+        with open(filepath, 'wb', buffering=1 << 16) as f:
+            writer = SvgWriter(f)
+            writer.header()
+            writer.begin('svg', (
+                ('xmlns:svg', SVG_URI),
+                ('xmlns', SVG_URI),
+                ('xmlns:sodipodi', SODIPODI_URI),
+                ('xmlns:inkscape', INKSCAPE_URI),
+                ('width', str(self.width)),
+                ('height', str(self.height)),
+                ('version', '1.1')))
+            for outline in self.outlines:
+                self.exportOutline(outline, writer)
+            writer.end('svg')
+            return f.tell()
+
+    def writeOutlines(self, filepath, svgDigest):
+        # Returns the number of bytes written.
+        outlines = self.outlines
+        header = numpy.zeros(1, dtype=OUTLINES_HEADER)
+        names = [outline.name.encode('utf-8') for outline in outlines]
+        pointOffsets = numpy.zeros(len(outlines) + 1, dtype='<u8')
+        pointOffsets[1:] = numpy.cumsum([len(outline.pathPoints) for outline in outlines])
+        nameOffsets = numpy.zeros(len(outlines) + 1, dtype='<u8')
+        nameOffsets[1:] = numpy.cumsum([len(name) for name in names])
+        colors = numpy.array([outline.color for outline in outlines], dtype='<f8').reshape(-1, 3)
+
+        # The same coordinates as the path data, before they are printed.
+        points = numpy.concatenate([outline.pathPoints for outline in outlines] + [numpy.empty((0, 2))])
+        coordinates = numpy.empty(points.shape, dtype=numpy.dtype(self.outlinesType).newbyteorder('<'))
+        coordinates[:, 0] = points[:, 0]*self.width
+        coordinates[:, 1] = (1.0 - points[:, 1])*self.height
+
+        header['magic'] = OUTLINES_MAGIC
+        header['digest'] = svgDigest.encode('ascii')
+        header['width'] = self.width
+        header['height'] = self.height
+        header['outlineCount'] = len(outlines)
+        header['pointCount'] = len(coordinates)
+        header['nameBytes'] = nameOffsets[-1]
+        header['coordinateSize'] = coordinates.dtype.itemsize
+        with open(filepath, 'wb') as f:
+            for part in (header, pointOffsets, nameOffsets, colors, coordinates):
+                f.write(part.tobytes())
+            f.write(b''.join(names))
+            return f.tell()
+
     def export(self, filepath):
         self.buildOutlines()
-        document = self.buildXml()
-        with open(filepath, 'wb') as f:
-            f.write(b'<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
-            f.write(ET.tostring(document, encoding="UTF-8"))
+        if self.simplifyTolerance > 0:
+            with self.statistics.stage('simplify'):
+                self.simplifyOutlines()
+        with self.statistics.stage('writeSvg'):
+            size = self.writeSvg(filepath)
+        if self.outlinesPath is not None:
+            with self.statistics.stage('writeOutlines'):
+                size += self.writeOutlines(self.outlinesPath, fileDigest(filepath))
+
+        self.statistics.count('outline points', sum([len(outline.points) for outline in self.outlines]))
+        self.statistics.count('path points', sum([len(outline.pathPoints) for outline in self.outlines]))
+        self.statistics.count('bytes written', size)
+        if self.printStatistics:
+            print(self.statistics.summary())
             
-def write_some_data(context, filepath, selected):
-    exporter = Exporter()
-    if selected:
-        for obj in context.selected_objects:
-            exporter.addObject(obj)
-    else:
-        for obj in bpy.data.objects:
-            exporter.addObject(obj)
-    exporter.export(filepath)
-    return {'FINISHED'}
+if bpy is not None:
+    # ExportHelper is a helper class, defines filename and
+    # invoke() function which calls the file selector.
+    from bpy_extras.io_utils import ExportHelper
+    from bpy.props import StringProperty, BoolProperty, EnumProperty, FloatProperty
+    from bpy.types import Operator
+
+
+    def addObject(exporter, object):
+        # Only support mesh objects
+        if object.type != 'MESH':
+            return
+        mesh = object.data
+        uvLayer = mesh.uv_layers.active
+        if uvLayer is None:
+            return
+
+        # Fetch the polygon and loop data in bulk.
+        polygonCount = len(mesh.polygons)
+        loopCount = len(mesh.loops)
+        loopStarts = numpy.empty(polygonCount, dtype=numpy.int32)
+        loopTotals = numpy.empty(polygonCount, dtype=numpy.int32)
+        materials = numpy.empty(polygonCount, dtype=numpy.int32)
+        mesh.polygons.foreach_get('loop_start', loopStarts)
+        mesh.polygons.foreach_get('loop_total', loopTotals)
+        mesh.polygons.foreach_get('material_index', materials)
+
+        loopVertices = numpy.empty(loopCount, dtype=numpy.int32)
+        uvs = numpy.empty(loopCount*2, dtype=numpy.float32)
+        mesh.loops.foreach_get('vertex_index', loopVertices)
+        uvLayer.data.foreach_get('uv', uvs)
+
+        # The outline name comes from the first vertex group of a vertex.
+        # There is no bulk access to the groups of the vertices, so they are
+        # only read when the object has any.
+        if len(object.vertex_groups) > 0:
+            vertexGroups = numpy.array([vertex.groups[0].group if len(vertex.groups) > 0 else -1 for vertex in mesh.vertices], dtype=numpy.int32)
+        else:
+            vertexGroups = numpy.full(len(mesh.vertices), -1, dtype=numpy.int32)
+        colors = [tuple(material.diffuse_color)[:3] if material is not None else (1.0, 1.0, 1.0) for material in mesh.materials]
+        groupNames = [group.name for group in object.vertex_groups]
+
+        exporter.addMesh(uvs.reshape(-1, 2), loopStarts, loopTotals, materials, vertexGroups[loopVertices], colors, groupNames)
+
+    def write_some_data(context, filepath, selected, weldDistance=EPSILON, simplifyTolerance=0.0, useCache=True, statisticsPath='',
+            writeOutlines=False, outlinePrecision='DOUBLE', printStatistics=False):
+        exporter = Exporter()
+        exporter.printStatistics = printStatistics
+        exporter.weldEpsilon = weldDistance
+        exporter.simplifyTolerance = simplifyTolerance
+        if useCache:
+            exporter.cachePath = filepath + '.cache'
+        if writeOutlines:
+            exporter.outlinesPath = filepath + '.outlines'
+            if outlinePrecision == 'SINGLE':
+                exporter.outlinesType = numpy.float32
+        if selected:
+            objects = context.selected_objects
+        else:
+            objects = bpy.data.objects
+        for obj in objects:
+            with exporter.statistics.stage('addObject'):
+                addObject(exporter, obj)
+        exporter.export(filepath)
+        if statisticsPath:
+            exporter.statistics.dump(bpy.path.abspath(statisticsPath))
+        return {'FINISHED'}
+
+
+    class ExportSomeData(Operator, ExportHelper):
+        """Plush toy SVG blueprint"""
+        bl_idname = "plushtoy.svg_blueprint"  # important since its how bpy.ops.import_test.some_data is constructed
+        bl_label = "Plush Toy SVG blueprint"
+
+        # ExportHelper mixin class uses this
+        filename_ext = ".svg"
+
+        filter_glob = StringProperty(
+                default="*.svg",
+                options={'HIDDEN'},
+                )
+
+        # List of operator properties, the attributes will be assigned
+        # to the class instance from the operator settings before calling.
+        selected = BoolProperty(
+                name="Export Selected",
+                description="Exports selected objects",
+                default=True,
+                )
 
+        weld_distance = FloatProperty(
+                name="Weld Distance",
+                description="Merges UV coordinates closer than this distance",
+                default=EPSILON,
+                min=0.0,
+                )
 
-# ExportHelper is a helper class, defines filename and
-# invoke() function which calls the file selector.
-from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
-from bpy.types import Operator
+        simplify_tolerance = FloatProperty(
+                name="Simplify Tolerance",
+                description="Maximum outline deviation in output units, zero keeps every vertex",
+                default=0.0,
+                min=0.0,
+                )
 
+        use_cache = BoolProperty(
+                name="Reuse Cached Outlines",
+                description="Keeps the outlines of every object next to the blueprint and only rebuilds the changed objects",
+                default=True,
+                )
 
-class ExportSomeData(Operator, ExportHelper):
-    """Plush toy SVG blueprint"""
-    bl_idname = "plushtoy.svg_blueprint"  # important since its how bpy.ops.import_test.some_data is constructed
-    bl_label = "Plush Toy SVG blueprint"
+        write_outlines = BoolProperty(
+                name="Write Binary Outlines",
+                description="Writes the outline coordinates next to the blueprint, for plush_tiles.py to load without parsing the SVG paths",
+                default=False,
+                )
 
-    # ExportHelper mixin class uses this
-    filename_ext = ".svg"
+        outline_precision = EnumProperty(
+                name="Outline Precision",
+                description="Floating point type of the binary outline coordinates",
+                items=(('DOUBLE', "Double", "64 bit coordinates, the same values as the SVG paths"),
+                       ('SINGLE', "Single", "32 bit coordinates, half the size")),
+                default='DOUBLE',
+                )
 
-    filter_glob = StringProperty(
-            default="*.svg",
-            options={'HIDDEN'},
-            )
+        print_statistics = BoolProperty(
+                name="Print Statistics",
+                description="Prints the stage timings and counters of the export to the console",
+                default=False,
+                )
 
-    # List of operator properties, the attributes will be assigned
-    # to the class instance from the operator settings before calling.
-    selected = BoolProperty(
-            name="Export Selected",
-            description="Exports selected objects",
-            default=True,
-            )
+        statistics_path = StringProperty(
+                name="Statistics File",
+                description="Writes the stage timings and counters of the export as JSON to this file",
+                default="",
+                subtype='FILE_PATH',
+                )
 
-    def execute(self, context):
-        return write_some_data(context, self.filepath, self.selected)
+        def execute(self, context):
+            return write_some_data(context, self.filepath, self.selected, self.weld_distance, self.simplify_tolerance, self.use_cache, self.statistics_path,
+                self.write_outlines, self.outline_precision, self.print_statistics)
 
 
-# Only needed if you want to add into a dynamic menu
-def menu_func_export(self, context):
-    self.layout.operator(ExportSomeData.bl_idname, text="Plush SVG Blueprint")
+    # Only needed if you want to add into a dynamic menu
+    def menu_func_export(self, context):
+        self.layout.operator(ExportSomeData.bl_idname, text="Plush SVG Blueprint")
 
 
-def register():
-    bpy.utils.register_class(ExportSomeData)
-    bpy.types.INFO_MT_file_export.append(menu_func_export)
+    def register():
+        bpy.utils.register_class(ExportSomeData)
+        bpy.types.INFO_MT_file_export.append(menu_func_export)
 
 
-def unregister():
-    bpy.utils.unregister_class(ExportSomeData)
-    bpy.types.INFO_MT_file_export.remove(menu_func_export)
+    def unregister():
+        bpy.utils.unregister_class(ExportSomeData)
+        bpy.types.INFO_MT_file_export.remove(menu_func_export)
 
 
-if __name__ == "__main__":
-    register()
+    if __name__ == "__main__":
+        register()
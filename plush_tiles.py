@@ -1,14 +1,29 @@
 #!/usr/bin/python
+import os
 import sys
+import hashlib
+import re
+import string
 import math
+import json
+import time
+import multiprocessing
+import numpy
+from contextlib import contextmanager
+from array import array
+from collections import OrderedDict
 from copy import deepcopy
+from xml.sax.saxutils import escape
 from lxml import etree
 
 SVG_NS = "http://www.w3.org/2000/svg"
 INKSCAPE_NS = "http://www.inkscape.org/namespaces/inkscape"
 SODIPODI_NS = "http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
 
+XLINK_NS = "http://www.w3.org/1999/xlink"
+
 NSMAP = {None : SVG_NS, 'inkscape': INKSCAPE_NS, 'sodipodi' : SODIPODI_NS}
+PAGES_NSMAP = {None : SVG_NS, 'inkscape': INKSCAPE_NS, 'sodipodi' : SODIPODI_NS, 'xlink': XLINK_NS}
 
 INFINITY = float('inf')
 
@@ -30,87 +45,459 @@ PAGE_HEIGHT = CHILE_LEGAL_HEIGHT
 PAGE_MARGIN = 5 
 JOIN_MARGIN = 5
 
+TRANSFORM_PLACEHOLDER = '@@TILE_TRANSFORM@@'
+FILE_NAME_PLACEHOLDER = '@@TILE_FILE_NAME@@'
+
+# Bumped whenever the cached path geometry changes meaning.
+GEOMETRY_CACHE_VERSION = '3'
+
+# Binary outlines written by plush_export.py next to a blueprint, see the
+# description of the format there.
+OUTLINES_MAGIC = b'PLUSHOL1'
+OUTLINES_HEADER = numpy.dtype([
+    ('magic', 'S8'),
+    ('digest', 'S40'),
+    ('width', '<f8'),
+    ('height', '<f8'),
+    ('outlineCount', '<u8'),
+    ('pointCount', '<u8'),
+    ('nameBytes', '<u8'),
+    ('coordinateSize', '<u8')])
+
+# Vertical space between the pages of a single document.
+PAGES_GAP = 10
+
+# Packed pieces are PACK_SPACING millimeters apart, below a strip for the label.
+PACK_SPACING = 5
+PACK_LABEL_HEIGHT = 20
+
+# Tiles only keep the paths that come closer than CULL_MARGIN millimeters.
+CULL_MARGIN = 1.0
+
+# Seconds between the checks of a watched input file.
+WATCH_INTERVAL = 0.5
+
 # Units
-UNIT_SCALE = 1.0
 PIXELS = 1.0/3.543307
 MM = 3.543307
 CM = 10.0*MM
 M = 1000.0*MM
 
+def millimeters(value):
+    return '%fmm' % value
+
+def userUnits(value):
+    # Millimeters as the PIXELS sized user units of the layer content.
+    return '%f' % (value / PIXELS)
+
+class TileConfig:
+    """
+    The page and unit settings of a tiling run. Page sizes and margins are
+    in millimeters, and unitScale converts the document units to pixels.
+    """
+    def __init__(self, pageWidth=PAGE_WIDTH, pageHeight=PAGE_HEIGHT, unitScale=1.0, pageMargin=PAGE_MARGIN, joinMargin=JOIN_MARGIN):
+        self.pageWidth = pageWidth
+        self.pageHeight = pageHeight
+        self.unitScale = unitScale
+        self.pageMargin = pageMargin
+        self.joinMargin = joinMargin
+
+    def usableSize(self):
+        margin = self.pageMargin*2
+        return Vector2(self.pageWidth - margin, self.pageHeight - margin)
+
+class Statistics:
+    timer = getattr(time, 'perf_counter', time.time)
+
+    def __init__(self):
+        self.stages = {}
+        self.stageOrder = []
+        self.counters = {}
+        self.counterOrder = []
+
+    @contextmanager
+    def stage(self, name):
+        start = self.timer()
+        try:
+            yield
+        finally:
+            self.addTime(name, self.timer() - start)
+
+    def addTime(self, name, seconds, calls=1):
+        if name not in self.stages:
+            self.stages[name] = [0.0, 0]
+            self.stageOrder.append(name)
+        stage = self.stages[name]
+        stage[0] += seconds
+        stage[1] += calls
+
+    def merge(self, other):
+        for name in other.stageOrder:
+            seconds, calls = other.stages[name]
+            self.addTime(name, seconds, calls)
+        for name in other.counterOrder:
+            self.count(name, other.counters[name])
+
+    def count(self, name, amount=1):
+        if name not in self.counters:
+            self.counters[name] = 0
+            self.counterOrder.append(name)
+        self.counters[name] += amount
+
+    def summary(self):
+        lines = ['%-24s %8s %10s' % ('stage', 'calls', 'seconds')]
+        for name in self.stageOrder:
+            seconds, calls = self.stages[name]
+            lines.append('%-24s %8d %10.4f' % (name, calls, seconds))
+        for name in self.counterOrder:
+            lines.append('%-24s %19d' % (name, self.counters[name]))
+        return '\n'.join(lines)
+
+    def toJson(self):
+        return {
+            'stages': dict([(name, {'seconds': seconds, 'calls': calls}) for name, (seconds, calls) in self.stages.items()]),
+            'counters': dict(self.counters),
+        }
+
+    def dump(self, fileName):
+        with open(fileName, 'w') as f:
+            json.dump(self.toJson(), f, indent=2, sort_keys=True)
+
 def tagName(tag, namespace):
     return '{%s}%s' % (namespace, tag)
 
 def attribName(tag, namespace):
     return '{%s}%s' % (namespace, tag)
 
-def extractPathPositions(path):
-    components = path.replace(',', ' ').split()
-    positions = []
-    i = 0
-    currentPosition = Vector2()
-    subpathStartPosition = Vector2()
-    while i < len(components):
-        newAction = components[i]
-        if newAction.isalpha():
-            action = newAction
-            i += 1
-
-        if action in ('M', 'L'):
-            currentPosition = Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-            if action == 'M':
-                subpathStartPosition = currentPosition
-            action = 'L'
-        elif action in ('m', 'l'):
-            currentPosition = currentPosition + Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-            if action == 'm':
-                subpathStartPosition = currentPosition
-            action = 'l'
-        elif action in ('Z', 'z'):
-            # This is important for relative movements.
-            currentPosition = subpathStartPosition
-        elif action == 'Q':
-            currentPosition = Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-            currentPosition = Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-        elif action == 'C':
-            currentPosition = Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-            currentPosition = Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-            currentPosition = Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-        elif action == 'q':
-            currentPosition = currentPosition + Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-            currentPosition = currentPosition + Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-        elif action == 'c':
-            currentPosition = currentPosition + Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-            currentPosition = currentPosition + Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
-            currentPosition = currentPosition + Vector2(float(components[i]), float(components[i+1]))
-            positions.append(currentPosition)
-            i += 2
+NUMBER_PATTERN = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+PATH_COMMAND_LETTERS = 'MmZzLlHhVvCcSsQqTtAa'
+PATH_TOKENS = re.compile(r'[%s]|%s' % (PATH_COMMAND_LETTERS, NUMBER_PATTERN))
+# Coordinate counts of the commands copied in bulk, 0 for closing ones.
+PATH_BULK_ARITIES = numpy.full(256, -1, dtype=numpy.intp)
+for command, arity in (('M', 2), ('L', 2), ('Q', 4), ('C', 6), ('Z', 0), ('z', 0)):
+    PATH_BULK_ARITIES[ord(command)] = arity
+PATH_COMMAND_POINTS = numpy.zeros(256, dtype=numpy.intp)
+for command, points in (('M', 1), ('L', 1), ('Q', 2), ('C', 3)):
+    PATH_COMMAND_POINTS[ord(command)] = points
+# Shortest run of bulk commands merged into one copy, shorter ones are cheaper
+# to copy command by command.
+PATH_BULK_RUN = 16
+# Character classes of path data, arcs excepted.
+PATH_SEPARATOR, PATH_NUMBER, PATH_COMMAND, PATH_OTHER = range(4)
+PATH_CHARACTER_CLASSES = numpy.full(256, PATH_OTHER, dtype=numpy.uint8)
+for characters, characterClass in ((' \t\r\n\f,', PATH_SEPARATOR), ('0123456789.eE+-', PATH_NUMBER), (PATH_COMMAND_LETTERS[:-2], PATH_COMMAND)):
+    PATH_CHARACTER_CLASSES[[ord(character) for character in characters]] = characterClass
+PATH_SEPARATORS = string.maketrans(PATH_COMMAND_LETTERS + ',', ' '*(len(PATH_COMMAND_LETTERS) + 1))
+# Arc flags are single digits and may be written without any separator.
+PATH_ARC_ARGUMENTS = re.compile(r'[\s,]*'.join(['(%s)' % NUMBER_PATTERN]*3 + ['([01])']*2 + ['(%s)' % NUMBER_PATTERN]*2))
+
+def arcToCubics(x1, y1, rx, ry, angle, largeArc, sweep, x2, y2):
+    # Endpoint to center parameterization, as described in the SVG implementation notes.
+    rx = abs(rx)
+    ry = abs(ry)
+    cosPhi = math.cos(math.radians(angle))
+    sinPhi = math.sin(math.radians(angle))
+    dx = (x1 - x2) * 0.5
+    dy = (y1 - y2) * 0.5
+    x1p = cosPhi*dx + sinPhi*dy
+    y1p = -sinPhi*dx + cosPhi*dy
+
+    # Radii that are too small are scaled up until the arc fits.
+    radiiScale = (x1p/rx)**2 + (y1p/ry)**2
+    if radiiScale > 1.0:
+        rx *= math.sqrt(radiiScale)
+        ry *= math.sqrt(radiiScale)
+
+    numerator = rx*rx*ry*ry - rx*rx*y1p*y1p - ry*ry*x1p*x1p
+    denominator = rx*rx*y1p*y1p + ry*ry*x1p*x1p
+    factor = math.sqrt(max(numerator, 0.0) / denominator)
+    if largeArc == sweep:
+        factor = -factor
+    cxp = factor*rx*y1p/ry
+    cyp = -factor*ry*x1p/rx
+    cx = cosPhi*cxp - sinPhi*cyp + (x1 + x2) * 0.5
+    cy = sinPhi*cxp + cosPhi*cyp + (y1 + y2) * 0.5
+
+    startAngle = math.atan2((y1p - cyp)/ry, (x1p - cxp)/rx)
+    deltaAngle = math.atan2((-y1p - cyp)/ry, (-x1p - cxp)/rx) - startAngle
+    if sweep and deltaAngle < 0:
+        deltaAngle += 2.0*math.pi
+    elif not sweep and deltaAngle > 0:
+        deltaAngle -= 2.0*math.pi
+
+    # One cubic per quarter turn at most.
+    segments = max(int(math.ceil(abs(deltaAngle) / (math.pi*0.5) - 1e-9)), 1)
+    step = deltaAngle / segments
+    k = 4.0/3.0 * math.tan(step*0.25)
+    coordinates = []
+    for i in range(segments):
+        a0 = startAngle + i*step
+        a1 = a0 + step
+        cos0 = math.cos(a0)
+        sin0 = math.sin(a0)
+        cos1 = math.cos(a1)
+        sin1 = math.sin(a1)
+        for ux, uy in ((cos0 - k*sin0, sin0 + k*cos0), (cos1 + k*sin1, sin1 - k*cos1), (cos1, sin1)):
+            ex = rx*ux
+            ey = ry*uy
+            coordinates.append(cosPhi*ex - sinPhi*ey + cx)
+            coordinates.append(sinPhi*ex + cosPhi*ey + cy)
+    coordinates[-2] = x2
+    coordinates[-1] = y2
+    return coordinates
+
+def splitPathData(path):
+    """
+    Splits the d attribute of a path into its command letter codes, the count
+    of numbers following each command, the index of the first of them, and all
+    the numbers. Arc arguments are returned apart since their flags may be
+    written without any separator.
+    """
+    if isinstance(path, str):
+        # Regular path data, with numbers delimited by separators or commands,
+        # is converted in one step; anything else goes through the tokenizer.
+        classes = PATH_CHARACTER_CLASSES[numpy.frombuffer(path, dtype=numpy.uint8)]
+        if not (classes == PATH_OTHER).any():
+            isNumber = classes == PATH_NUMBER
+            numberStarts = isNumber.copy()
+            numberStarts[1:] &= ~isNumber[:-1]
+            # The trailing number is only read when no malformed one stopped the conversion.
+            numbers = numpy.fromstring(path.translate(PATH_SEPARATORS) + ' 0', dtype=numpy.float64, sep=' ')[:-1]
+            if len(numbers) == numberStarts.sum():
+                commandIndices = numpy.flatnonzero(classes == PATH_COMMAND)
+                valueStarts = numpy.cumsum(numberStarts)[commandIndices]
+                counts = numpy.diff(numpy.append(valueStarts, len(numbers)))
+                return numpy.frombuffer(path, dtype=numpy.uint8)[commandIndices], counts, valueStarts, numbers, []
+
+    tokens = PATH_TOKENS.findall(path)
+    commandIndices = [i for i, token in enumerate(tokens) if token in PATH_COMMAND_LETTERS]
+    letters = numpy.array([ord(tokens[i]) for i in commandIndices], dtype=numpy.uint8)
+    valueStarts = numpy.array(commandIndices, dtype=numpy.intp) - numpy.arange(len(commandIndices))
+    counts = numpy.diff(numpy.append(commandIndices, len(tokens))) - 1
+    numbers = numpy.array([token for token in tokens if token not in PATH_COMMAND_LETTERS], dtype=numpy.float64)
+    arcs = [[float(value) for arcArguments in PATH_ARC_ARGUMENTS.findall(' '.join(tokens[i + 1:i + 1 + count])) for value in arcArguments]
+            for i, count in zip(commandIndices, counts) if tokens[i] in 'Aa']
+    return letters, counts, valueStarts, numbers, arcs
+
+def parsePathData(path):
+    """
+    Parses the d attribute of a path into absolute M, L, Q, C and Z commands.
+    Returns the command letters, as a string, and a flat float64 array with the
+    x, y coordinates consumed by them: one point for M and L, two for Q, three
+    for C.
+    """
+    letters, counts, valueStarts, numbers, arcs = splitPathData(path)
+    if not len(letters):
+        return '', numpy.empty(0)
+
+    # Absolute lines and curves, and closing commands, are copied in bulk.
+    arities = PATH_BULK_ARITIES[letters]
+    bulk = ((arities > 0) & (counts > 0) & (counts % numpy.maximum(arities, 1) == 0)) | ((arities == 0) & (counts == 0))
+    if bulk.all():
+        return bulkCommands(letters, counts).tobytes(), numbers[valueStarts[0]:]
+
+    commands = []
+    chunks = []
+    positions = array('d')
+    x = y = 0.0
+    startX = startY = 0.0
+    controlX = controlY = 0.0
+    previous = None
+    arcs = iter(arcs)
+    breaks = numpy.append(numpy.flatnonzero(~bulk), len(letters))
+    runEnds = breaks[numpy.searchsorted(breaks, numpy.arange(len(letters)))].tolist()
+    commandCount = len(letters)
+    commandLetters = letters.tobytes()
+    bulk = bulk.tolist()
+    valueEnds = (valueStarts + counts).tolist()
+    valueStarts = valueStarts.tolist()
+    commandIndex = 0
+    while commandIndex < commandCount:
+        end = runEnds[commandIndex]
+        if end - commandIndex >= PATH_BULK_RUN:
+            # Long runs of bulk commands are merged and copied at once.
+            run = bulkCommands(letters[commandIndex:end], counts[commandIndex:end])
+            values = numbers[valueStarts[commandIndex]:valueEnds[end - 1]]
+            commands.append(run.tobytes())
+            if len(positions):
+                chunks.append(numpy.frombuffer(positions, dtype=numpy.float64))
+                positions = array('d')
+            chunks.append(values)
+            points = PATH_COMMAND_POINTS[run]
+            moves = numpy.flatnonzero(run == ord('M'))
+            if len(moves):
+                startIndex = 2*(numpy.cumsum(points) - points)[moves[-1]]
+                startX = float(values[startIndex])
+                startY = float(values[startIndex + 1])
+            previous = chr(run[-1])
+            if previous == 'Z':
+                x = startX
+                y = startY
+            else:
+                x = float(values[-2])
+                y = float(values[-1])
+                if len(values) >= 4:
+                    controlX = float(values[-4])
+                    controlY = float(values[-3])
+            commandIndex = end
+            continue
+
+        command = commandLetters[commandIndex]
+        action = command.upper()
+        relative = command != action
+        if action == 'A':
+            values = next(arcs)
         else:
-            print components
-            assert False
+            values = numbers[valueStarts[commandIndex]:valueEnds[commandIndex]].tolist()
+        count = len(values)
+        copied = bulk[commandIndex]
+        commandIndex += 1
+
+        # Absolute lines and curves out of long runs are copied one by one.
+        if copied and action != 'Z':
+            positions.extend(values)
+            repeats = count // PATH_BULK_ARITIES[ord(action)]
+            if action == 'M':
+                commands.append('M')
+                startX = values[0]
+                startY = values[1]
+                action = 'L'
+                repeats -= 1
+            commands.append(action * repeats)
+            x = values[-2]
+            y = values[-1]
+            if count >= 4:
+                controlX = values[-4]
+                controlY = values[-3]
+            previous = action
+            continue
+
+        if action == 'Z':
+            commands.append('Z')
+            x = startX
+            y = startY
+            previous = action
+            continue
+
+        i = 0
+        while i < count:
+            ox = x if relative else 0.0
+            oy = y if relative else 0.0
+            if action == 'M':
+                x = values[i] + ox
+                y = values[i+1] + oy
+                i += 2
+                commands.append('M')
+                positions.extend((x, y))
+                startX = x
+                startY = y
+                # Further pairs are implicit line commands.
+                action = 'L'
+            elif action == 'L':
+                x = values[i] + ox
+                y = values[i+1] + oy
+                i += 2
+                commands.append('L')
+                positions.extend((x, y))
+            elif action == 'H':
+                x = values[i] + ox
+                i += 1
+                commands.append('L')
+                positions.extend((x, y))
+            elif action == 'V':
+                y = values[i] + oy
+                i += 1
+                commands.append('L')
+                positions.extend((x, y))
+            elif action in ('C', 'S'):
+                if action == 'C':
+                    x1 = values[i] + ox
+                    y1 = values[i+1] + oy
+                    i += 2
+                elif previous in ('C', 'S'):
+                    x1 = 2.0*x - controlX
+                    y1 = 2.0*y - controlY
+                else:
+                    x1 = x
+                    y1 = y
+                controlX = values[i] + ox
+                controlY = values[i+1] + oy
+                x = values[i+2] + ox
+                y = values[i+3] + oy
+                i += 4
+                commands.append('C')
+                positions.extend((x1, y1, controlX, controlY, x, y))
+            elif action in ('Q', 'T'):
+                if action == 'Q':
+                    controlX = values[i] + ox
+                    controlY = values[i+1] + oy
+                    i += 2
+                elif previous in ('Q', 'T'):
+                    controlX = 2.0*x - controlX
+                    controlY = 2.0*y - controlY
+                else:
+                    controlX = x
+                    controlY = y
+                x = values[i] + ox
+                y = values[i+1] + oy
+                i += 2
+                commands.append('Q')
+                positions.extend((controlX, controlY, x, y))
+            elif action == 'A':
+                rx, ry, angle, largeArc, sweep = values[i:i+5]
+                endX = values[i+5] + ox
+                endY = values[i+6] + oy
+                i += 7
+                if endX == x and endY == y:
+                    pass
+                elif rx == 0 or ry == 0:
+                    commands.append('L')
+                    positions.extend((endX, endY))
+                else:
+                    cubics = arcToCubics(x, y, rx, ry, angle, largeArc, sweep, endX, endY)
+                    commands += ['C'] * (len(cubics) // 6)
+                    positions.extend(cubics)
+                x = endX
+                y = endY
+            previous = action
+
+    commands = ''.join(commands)
+    if len(positions):
+        chunks.append(numpy.frombuffer(positions, dtype=numpy.float64))
+    return commands, numpy.concatenate(chunks) if chunks else numpy.empty(0)
+
+def bulkCommands(letters, counts):
+    """
+    Expands absolute M, L, Q, C and Z commands by their implicit repetitions,
+    given their letter codes and coordinate counts.
+    """
+    arities = PATH_BULK_ARITIES[letters]
+    repeats = numpy.where(arities > 0, counts // numpy.maximum(arities, 1), 1)
+    codes = numpy.repeat(letters, repeats)
+    # Pairs after the first of an M command are implicit line commands.
+    repeated = numpy.ones(len(codes), dtype=bool)
+    repeated[numpy.cumsum(repeats) - repeats] = False
+    codes[repeated & (codes == ord('M'))] = ord('L')
+    codes[codes == ord('z')] = ord('Z')
+    return codes
+
+def pathSegments(commands):
+    """
+    Returns the first point and point count of every L, Q and C command, and
+    the point ranges of the subpaths started by every M command.
+    """
+    codes = numpy.frombuffer(commands.encode('ascii'), dtype=numpy.uint8)
+    counts = PATH_COMMAND_POINTS[codes]
+    offsets = numpy.cumsum(counts) - counts
+    moves = codes == ord('M')
+    drawn = (counts > 0) & ~moves & (offsets > 0)
+    starts = numpy.union1d([0], offsets[moves])
+    ends = numpy.append(starts[1:], counts.sum())
+    valid = ends > starts
+    return offsets[drawn], counts[drawn], starts[valid], ends[valid]
 
-    return positions
+def extractPathPositions(path):
+    return parsePathData(path)[1].reshape(-1, 2)
 
 # Vector2 class
 class Vector2:
@@ -146,47 +533,120 @@ class Vector2:
         return "Vector2(%f, %f)" % (self.x, self.y)
 
 class Matrix:
+    # A 2x3 affine transform [[a, c, e], [b, d, f]], as in the SVG matrix().
     def __init__(self, values = None):
-        self.values = values
-        if self.values is None:
-            self.values = [0]*9
+        if values is None:
+            values = [[1, 0, 0], [0, 1, 0]]
+        self.values = numpy.asarray(values, dtype=numpy.float64).reshape(2, 3)
 
     def at(self, i, j):
-        return self.values[i*3 + j]
+        if i == 2:
+            return float(j == 2)
+        return self.values[i, j]
 
     def __mul__(self, o):
-        values = []
-        for i in range(3):
-            for j in range(3):
-                val = 0
-                for k in range(3):
-                    val += self.at(i, k)*o.at(k, j)
-                values.append(val)
+        linear = self.values[:, :2]
+        values = numpy.empty((2, 3))
+        values[:, :2] = linear.dot(o.values[:, :2])
+        values[:, 2] = linear.dot(o.values[:, 2]) + self.values[:, 2]
         return Matrix(values)
 
+    def isIdentity(self):
+        return (self.values == IDENTITY_VALUES).all()
+
+    def inverse(self):
+        linear = numpy.linalg.inv(self.values[:, :2])
+        return Matrix(numpy.hstack([linear, -linear.dot(self.values[:, 2:])]))
+
+    def apply(self, points):
+        # Transforms a N x 2 array of points at once.
+        return points.dot(self.values[:, :2].T) + self.values[:, 2]
+
     @classmethod
     def translation(cls, t):
         return cls(
-            [1, 0, t.x,
-             0, 1, t.y,
-             0, 0, 1])
+            [[1, 0, t.x],
+             [0, 1, t.y]])
 
     @classmethod
     def scale(cls, s):
         return cls(
-            [s.x, 0, 0,
-             0, s.y, 0,
-             0, 0, 1])
+            [[s.x, 0, 0],
+             [0, s.y, 0]])
+
+    @classmethod
+    def rotation(cls, degrees):
+        angle = math.radians(degrees)
+        c = math.cos(angle)
+        s = math.sin(angle)
+        return cls(
+            [[c, -s, 0],
+             [s, c, 0]])
+
+    @classmethod
+    def skew(cls, degreesX, degreesY):
+        return cls(
+            [[1, math.tan(math.radians(degreesX)), 0],
+             [math.tan(math.radians(degreesY)), 1, 0]])
 
     def __repr__(self):
-        return "Matrix(%s)" % repr(self.values)
+        return "Matrix(%s)" % repr(self.values.tolist())
 
     def __str__(self):
-        return str(self.values)
+        return str(self.values.tolist())
 
     def svgMatrix(self):
         return "matrix(%f,%f,%f,%f,%f,%f)" % (self.at(0,0), self.at(1,0), self.at(0,1), self.at(1,1), self.at(0,2), self.at(1,2))
 
+IDENTITY_VALUES = numpy.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+IDENTITY = Matrix()
+
+TRANSFORM_FUNCTIONS = re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)')
+TRANSFORM_NUMBERS = re.compile(NUMBER_PATTERN)
+
+def parseTransform(text):
+    """
+    Parses the value of a transform attribute into a Matrix, composing its
+    functions from left to right. Returns IDENTITY for an empty value.
+    """
+    if not text:
+        return IDENTITY
+    result = IDENTITY
+    for function, arguments in TRANSFORM_FUNCTIONS.findall(text):
+        values = [float(value) for value in TRANSFORM_NUMBERS.findall(arguments)]
+        if function == 'matrix' and len(values) == 6:
+            a, b, c, d, e, f = values
+            transform = Matrix([[a, c, e], [b, d, f]])
+        elif function == 'translate' and values:
+            transform = Matrix.translation(Vector2(values[0], values[1] if len(values) > 1 else 0.0))
+        elif function == 'scale' and values:
+            transform = Matrix.scale(Vector2(values[0], values[1] if len(values) > 1 else values[0]))
+        elif function == 'rotate' and len(values) == 3:
+            center = Vector2(values[1], values[2])
+            transform = Matrix.translation(center) * Matrix.rotation(values[0]) * Matrix.translation(-center)
+        elif function == 'rotate' and values:
+            transform = Matrix.rotation(values[0])
+        elif function == 'skewX' and values:
+            transform = Matrix.skew(values[0], 0.0)
+        elif function == 'skewY' and values:
+            transform = Matrix.skew(0.0, values[0])
+        else:
+            continue
+        result = result * transform
+    return result
+
+def formatPathData(commands, positions):
+    # Writes normalized commands back as absolute path data.
+    parts = []
+    index = 0
+    for command in commands:
+        count = PATH_COMMAND_POINTS[ord(command)]
+        parts.append(command)
+        for x, y in positions[index:index + count]:
+            parts.append('%.9g,%.9g' % (x, y))
+        index += count
+    return ' '.join(parts)
+
 class AABox2:
     def __init__(self, cmin=None, cmax=None):
         self.min = cmin
@@ -221,11 +681,24 @@ class AABox2:
     def __repr__(self):
         return "AABox2(%s, %s)" % (repr(self.min), repr(self.max))
 
+EMPTY_BOUNDS = numpy.array([[INFINITY, INFINITY], [-INFINITY, -INFINITY]])
+
+def boundsFromPoints(points):
+    if len(points) == 0:
+        return EMPTY_BOUNDS.copy()
+    return numpy.array([points.min(axis=0), points.max(axis=0)])
+
+def boundsFromBounds(bounds):
+    if len(bounds) == 0:
+        return EMPTY_BOUNDS.copy()
+    bounds = numpy.asarray(bounds)
+    return numpy.array([bounds[:, 0].min(axis=0), bounds[:, 1].max(axis=0)])
+
+def boundingBoxFromBounds(bounds):
+    return AABox2(Vector2(float(bounds[0, 0]), float(bounds[0, 1])), Vector2(float(bounds[1, 0]), float(bounds[1, 1])))
+
 def boundingBoxFromPoints(points):
-    box = AABox2()
-    for p in points:
-        box.addPoint(p)
-    return box
+    return boundingBoxFromBounds(boundsFromPoints(numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)))
 
 def boundingBoxFromBoxes(boxes):
     box = AABox2()
@@ -233,7 +706,75 @@ def boundingBoxFromBoxes(boxes):
         box.addBox(b)
     return box
 
+class MaxRectsBin:
+    """
+    A sheet filled with the MaxRects algorithm: the free space is kept as
+    the list of maximal free rectangles, and every piece goes where it
+    leaves the shortest leftover side, possibly rotated by 90 degrees.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.freeRectangles = [(0.0, 0.0, width, height)]
+        self.placements = []
+
+    def findPosition(self, width, height):
+        best = None
+        for x, y, w, h in self.freeRectangles:
+            for rotated, pw, ph in ((False, width, height), (True, height, width)):
+                if pw <= w and ph <= h:
+                    leftoverX = w - pw
+                    leftoverY = h - ph
+                    score = (min(leftoverX, leftoverY), max(leftoverX, leftoverY))
+                    if best is None or score < best[0]:
+                        best = (score, x, y, rotated)
+        return best
+
+    def insert(self, width, height, item):
+        best = self.findPosition(width, height)
+        if best is None:
+            return False
+        score, x, y, rotated = best
+        if rotated:
+            width, height = height, width
+        self.placements.append((item, x, y, rotated))
+        self.splitFreeRectangles(x, y, width, height)
+        return True
+
+    def splitFreeRectangles(self, x, y, width, height):
+        split = []
+        for free in self.freeRectangles:
+            fx, fy, fw, fh = free
+            if x >= fx + fw or x + width <= fx or y >= fy + fh or y + height <= fy:
+                split.append(free)
+                continue
+            if x > fx:
+                split.append((fx, fy, x - fx, fh))
+            if x + width < fx + fw:
+                split.append((x + width, fy, fx + fw - x - width, fh))
+            if y > fy:
+                split.append((fx, fy, fw, y - fy))
+            if y + height < fy + fh:
+                split.append((fx, y + height, fw, fy + fh - y - height))
+
+        # Drop the rectangles contained in another one, keeping one of each duplicate.
+        self.freeRectangles = []
+        for i, (ax, ay, aw, ah) in enumerate(split):
+            contained = False
+            for j, (bx, by, bw, bh) in enumerate(split):
+                if i != j and bx <= ax and by <= ay and ax + aw <= bx + bw and ay + ah <= by + bh:
+                    if (ax, ay, aw, ah) != (bx, by, bw, bh) or j < i:
+                        contained = True
+                        break
+            if not contained:
+                self.freeRectangles.append((ax, ay, aw, ah))
+
 class Node:
+    # Iterator over cached path geometry, consumed in document order.
+    geometry = None
+    # Transform from the node to the space of its layer parent.
+    matrix = IDENTITY
+
     def __init__(self, node):
         self.node = node
 
@@ -243,88 +784,185 @@ class Node:
     def parseChild(self, node):
         tag = node.tag
         if tag == tagName('g', SVG_NS):
-            return Group(node)
+            return Group(node, self)
         if tag == tagName('path', SVG_NS):
-            return Path(node)
+            return Path(node, self)
         if tag == tagName('text', SVG_NS):
-            return Group(node)
+            return Group(node, self)
         return GenericNode(node)
 
+    def composeTransform(self, node, parent):
+        self.geometry = parent.geometry
+        transform = node.attrib.get('transform')
+        if transform:
+            self.matrix = parent.matrix * parseTransform(transform)
+        else:
+            self.matrix = parent.matrix
+
+    def bakeTransforms(self, base):
+        pass
+
+    bounds = EMPTY_BOUNDS
+
     def getBoundingBox(self):
-        return AABox2()
+        return boundingBoxFromBounds(self.bounds)
+
+    def iterPaths(self):
+        for child in getattr(self, 'children', ()):
+            for path in child.iterPaths():
+                yield path
 
 class GenericNode(Node):
     def __init__(self, node):
         Node.__init__(self, node)
 
 class Group(Node):
-    def __init__(self, node):
+    def __init__(self, node, parent=None):
         Node.__init__(self, node)
+        if parent is not None:
+            self.composeTransform(node, parent)
         self.children = self.parseChildren(node)
-        self.boundingBox = boundingBoxFromBoxes(map(lambda child: child.getBoundingBox(), self.children))
 
     def getBoundingBox(self):
-        return self.boundingBox
+        return boundingBoxFromBounds(boundsFromBounds([path.bounds for path in self.iterPaths()]))
+
+    def isBakeable(self):
+        # Only plain groups of paths may lose their transform.
+        if self.node.tag != tagName('g', SVG_NS):
+            return False
+        for child in self.children:
+            if isinstance(child, Path):
+                continue
+            if not isinstance(child, Group) or not child.isBakeable():
+                return False
+        return True
+
+    def bakeTransforms(self, base):
+        # The children of a group that keeps its transform are baked into
+        # the group space instead.
+        if self.isBakeable():
+            self.node.attrib.pop('transform', None)
+        else:
+            base = self.matrix
+        for child in self.children:
+            child.bakeTransforms(base)
 
 class Path(Node):
-    def __init__(self, node):
+    def __init__(self, node, parent=None):
         Node.__init__(self, node)
-        self.positions = extractPathPositions(node.attrib['d'])
-        self.boundingBox = boundingBoxFromPoints(self.positions)
-
-    def getBoundingBox(self):
-        return self.boundingBox
+        if parent is not None:
+            self.composeTransform(node, parent)
+        if self.geometry is not None:
+            self.positions, self.segmentStarts, self.segmentCounts, self.subpathStarts, self.subpathEnds, self.bounds = next(self.geometry)
+            return
+        commands, coordinates = parsePathData(node.attrib.get('d', ''))
+        self.positions = coordinates.reshape(-1, 2)
+        if self.matrix is not IDENTITY:
+            self.positions = self.matrix.apply(self.positions)
+        self.segmentStarts, self.segmentCounts, self.subpathStarts, self.subpathEnds = pathSegments(commands)
+        self.bounds = boundsFromPoints(self.positions)
+
+    def getGeometry(self):
+        return self.positions, self.segmentStarts, self.segmentCounts, self.subpathStarts, self.subpathEnds, self.bounds
+
+    def iterPaths(self):
+        yield self
+
+    def bakeTransforms(self, base):
+        # Rewrites the path data in the space of base.
+        relative = base.inverse() * self.matrix
+        if relative.isIdentity() and 'transform' not in self.node.attrib:
+            return
+        commands, coordinates = parsePathData(self.node.attrib.get('d', ''))
+        positions = relative.apply(coordinates.reshape(-1, 2))
+        self.node.attrib['d'] = formatPathData(commands, positions)
+        self.node.attrib.pop('transform', None)
 
 class Text(Node):
     def __init__(self, node):
         Node.__init__(self, node)
         self.text = node.text
 
+def layerName(node):
+    return node.attrib.get(attribName('label', INKSCAPE_NS), 'layer')
+
 class Layer(Node):
-    def __init__(self, node):
+    # Leave the tile files that already hold the exported bytes untouched.
+    keepUnchanged = False
+
+    def __init__(self, node, statistics, geometry=None, config=None):
         Node.__init__(self, node)
-        self.name = node.attrib.get(attribName('label', INKSCAPE_NS), 'layer')
+        if config is None:
+            config = TileConfig()
+        self.statistics = statistics
+        self.config = config
+        self.name = layerName(node)
+        self.geometry = geometry
+        # The layer transform is replaced on export, so its own transform
+        # goes into the path positions and the page transform.
+        self.matrix = parseTransform(node.attrib.get('transform'))
         self.children = self.parseChildren(node)
-        self.boundingBox = boundingBoxFromBoxes(map(lambda child: child.getBoundingBox(), self.children))
+        self.geometry = None
+
+        # One reduction over the boxes of every path in the layer.
+        self.paths = paths = list(self.iterPaths())
+        self.bounds = boundsFromBounds([path.bounds for path in paths])
+        self.boundingBox = boundingBoxFromBounds(self.bounds)
+
+        statistics.count('layers')
+        statistics.count('paths', len(paths))
+        for path in paths:
+            statistics.count('path points', len(path.positions))
 
     def getBoundingBox(self):
         return self.boundingBox
 
+    def scaleForWidth(self, targetWidth):
+        layerWidth = self.getBoundingBox().getWidth()
+        return targetWidth / (layerWidth * PIXELS)
+
+    def scaleForHeight(self, targetHeight):
+        layerHeight = self.getBoundingBox().getHeight()
+        return targetHeight / (layerHeight * PIXELS)
+
     def transformScale(self, scale):
-        self.transform = Matrix.scale(Vector2(scale, scale)) * Matrix.translation(-self.boundingBox.min)
+        self.scale = scale
+        self.transform = Matrix.scale(Vector2(scale, scale)) * Matrix.translation(-self.boundingBox.min) * self.matrix
         self.transformedSized = self.boundingBox.getSize() * scale
 
-    def addMarginRectangle(self, parent, x, y, w, h):
+    def bakeTransforms(self):
+        # Folds the transforms below the layer into the path data.
+        for child in self.children:
+            child.bakeTransforms(self.matrix)
+
+    def addMarginRectangle(self, parent, x, y, w, h, length=millimeters):
         rect = etree.SubElement(parent, tagName('rect', SVG_NS))
-        rect.attrib['width'] = '%fmm' % w
-        rect.attrib['height'] = '%fmm' % h
-        rect.attrib['x'] = '%fmm' % x
-        rect.attrib['y'] = '%fmm' % y
+        rect.attrib['width'] = length(w)
+        rect.attrib['height'] = length(h)
+        rect.attrib['x'] = length(x)
+        rect.attrib['y'] = length(y)
         rect.attrib['style'] = 'fill: red; fill-opacity:0.3;'
 
-    def addPageRectangle(self, parent, x, y, w, h):
+    def addPageRectangle(self, parent, x, y, w, h, length=millimeters):
         rect = etree.SubElement(parent, tagName('rect', SVG_NS))
-        rect.attrib['width'] = '%fmm' % w
-        rect.attrib['height'] = '%fmm' % h
-        rect.attrib['x'] = '%fmm' % x
-        rect.attrib['y'] = '%fmm' % y
+        rect.attrib['width'] = length(w)
+        rect.attrib['height'] = length(h)
+        rect.attrib['x'] = length(x)
+        rect.attrib['y'] = length(y)
         rect.attrib['style'] = 'fill-opacity: 0; stroke: black;'
 
-    def addFileName(self, parent, fileName):
+    def addFileName(self, parent, fileName, length=millimeters):
         text = etree.SubElement(parent, tagName('text', SVG_NS))
-        text.attrib['x'] = "%fmm" % (JOIN_MARGIN*3)
-        text.attrib['y'] = "%fmm" % (JOIN_MARGIN*3)
+        text.attrib['x'] = length(self.config.joinMargin*3)
+        text.attrib['y'] = length(self.config.joinMargin*3)
         text.attrib['style'] = "fill: gray; font-size: 20pt"
         text.text = fileName
 
-    def exportPart(self, pageSize, i, j, outdir):
-        fileName = '%s/%s_%d_%d.svg' % (outdir, self.name, i, j)
-        
-        viewPosition = Vector2(i*(pageSize.x - JOIN_MARGIN), j*(pageSize.y - JOIN_MARGIN))
-        viewTransform = Matrix.translation(-viewPosition/PIXELS)
-
+    def tileTemplate(self, pageSize):
+        # The tiles of a layer only differ in the view transform and the file
+        # name, so the page is serialized once with placeholders for both.
         newLayer = deepcopy(self.node)
-        newLayer.attrib['transform'] = (viewTransform*self.transform).svgMatrix()
+        newLayer.attrib['transform'] = TRANSFORM_PLACEHOLDER
 
         newRoot = etree.Element(tagName('svg', SVG_NS), nsmap=NSMAP)
         newRoot.attrib['version'] = '1.1'
@@ -332,88 +970,899 @@ class Layer(Node):
         newRoot.attrib['height'] = '%fmm' % pageSize.y
 
         newRoot.append(newLayer)
-
+        self.addPageDecorations(newRoot, pageSize, FILE_NAME_PLACEHOLDER)
+
+        # Culled tiles temporarily detach the copies of their hidden paths.
+        copies = dict(zip(self.node.iter(), newLayer.iter()))
+        self.tileRoot = newRoot
+        self.tilePathNodes = [copies[path.node] for path in self.paths]
+        return self.serializeTemplate()
+
+    def serializeTemplate(self):
+        text = etree.tostring(self.tileRoot, encoding="UTF-8", xml_declaration = True, pretty_print=True)
+        head, rest = text.split(TRANSFORM_PLACEHOLDER.encode('ascii'))
+        middle, tail = rest.split(FILE_NAME_PLACEHOLDER.encode('ascii'))
+        return head, middle, tail
+
+    def culledTemplate(self, visible):
+        hidden = numpy.ones(len(self.paths), dtype=bool)
+        hidden[visible] = False
+        # Paths are detached from the last one, remembering their previous
+        # sibling, and put back from the first one. Looking up or inserting
+        # at an index would walk the siblings every time.
+        detached = []
+        for index in numpy.flatnonzero(hidden)[::-1]:
+            node = self.tilePathNodes[index]
+            parent = node.getparent()
+            detached.append((parent, node.getprevious(), node))
+            parent.remove(node)
+        try:
+            return self.serializeTemplate()
+        finally:
+            for parent, previous, node in reversed(detached):
+                if previous is None:
+                    parent.insert(0, node)
+                else:
+                    previous.addnext(node)
+
+    def tilePaths(self, pageSize, columns, rows):
+        """
+        Maps every (column, row) tile to the indices of the paths that may
+        draw on it. A path is kept when one of its segments, or the edge
+        closing one of its subpaths, comes within CULL_MARGIN millimeters of
+        the page, or when the page lies inside one of its subpaths.
+        """
+        origin = numpy.array([self.boundingBox.min.x, self.boundingBox.min.y])
+        factor = self.scale * PIXELS
+        size = numpy.array([pageSize.x, pageSize.y])
+        step = size - self.config.joinMargin
+        lastTile = numpy.array([columns - 1, rows - 1])
+        tileCenters = numpy.stack(numpy.meshgrid(numpy.arange(columns), numpy.arange(rows), indexing='ij'), axis=-1) * step + size * 0.5
+
+        tiles = {}
+        for index, path in enumerate(self.paths):
+            if len(path.positions) == 0:
+                continue
+            # Work in page millimeters.
+            points = (path.positions - origin) * factor
+            starts = path.subpathStarts
+            ends = path.subpathEnds
+
+            # The box of a segment holds the previous point and its own points,
+            # so it also holds the curve they control.
+            segmentFirst = path.segmentStarts - 1
+            boxMins = points[segmentFirst]
+            boxMaxs = boxMins.copy()
+            for offset in range(1, 4):
+                following = points[segmentFirst + numpy.minimum(offset, path.segmentCounts)]
+                numpy.minimum(boxMins, following, out=boxMins)
+                numpy.maximum(boxMaxs, following, out=boxMaxs)
+            closingFirst = points[starts]
+            closingLast = points[ends - 1]
+            boxMins = numpy.concatenate([boxMins, numpy.minimum(closingFirst, closingLast)]) - CULL_MARGIN
+            boxMaxs = numpy.concatenate([boxMaxs, numpy.maximum(closingFirst, closingLast)]) + CULL_MARGIN
+
+            # Tile i spans [i*step, i*step + size] along each axis.
+            first = numpy.maximum(numpy.ceil((boxMins - size) / step), 0).astype(numpy.intp)
+            last = numpy.minimum(numpy.floor(boxMaxs / step), lastTile).astype(numpy.intp)
+            spans = last - first + 1
+            hit = numpy.zeros((columns, rows), dtype=bool)
+            for di in range(spans[:, 0].max()):
+                for dj in range(spans[:, 1].max()):
+                    covers = (spans[:, 0] > di) & (spans[:, 1] > dj)
+                    hit[first[covers, 0] + di, first[covers, 1] + dj] = True
+
+            # The tiles untouched by the outline within the path bounds are
+            # either completely inside or completely outside of it.
+            pathFirst = numpy.maximum(numpy.ceil((points.min(axis=0) - size) / step), 0).astype(numpy.intp)
+            pathLast = numpy.minimum(numpy.floor(points.max(axis=0) / step), lastTile).astype(numpy.intp)
+            enclosed = numpy.zeros((columns, rows), dtype=bool)
+            enclosed[pathFirst[0]:pathLast[0] + 1, pathFirst[1]:pathLast[1] + 1] = True
+            enclosed &= ~hit
+            if enclosed.any():
+                hit[enclosed] = self.insideSubpaths(points, starts, ends, tileCenters[enclosed])
+
+            for i, j in zip(*numpy.nonzero(hit)):
+                tiles.setdefault((int(i), int(j)), []).append(index)
+        return dict([(tile, numpy.array(indices, dtype=numpy.intp)) for tile, indices in tiles.items()])
+
+    def insideSubpaths(self, points, starts, ends, queries):
+        # Non-zero winding of the queries around each closed subpath, a
+        # batch of queries at a time to bound the size of the edge tests.
+        following = numpy.arange(1, len(points) + 1)
+        following[ends - 1] = starts
+        a = points
+        b = points[following]
+        inside = numpy.zeros(len(queries), dtype=bool)
+        batch = max(1, (1 << 20) // len(points))
+        for first in range(0, len(queries), batch):
+            qx = queries[first:first + batch, 0:1]
+            qy = queries[first:first + batch, 1:2]
+            side = (b[:, 0] - a[:, 0]) * (qy - a[:, 1]) - (qx - a[:, 0]) * (b[:, 1] - a[:, 1])
+            upward = (a[:, 1] <= qy) & (b[:, 1] > qy) & (side > 0)
+            downward = (a[:, 1] > qy) & (b[:, 1] <= qy) & (side < 0)
+            winding = upward.astype(numpy.intp) - downward
+            inside[first:first + batch] = (numpy.add.reduceat(winding, starts, axis=1) != 0).any(axis=1)
+        return inside
+
+    def addPageDecorations(self, parent, pageSize, fileName, joinMargins=True, length=millimeters):
         # Add margin
-        #self.addMarginRectangle(newRoot, 0, 0, pageSize.x, JOIN_MARGIN)
-        #self.addMarginRectangle(newRoot, 0, 0, JOIN_MARGIN, pageSize.y)
+        #self.addMarginRectangle(parent, 0, 0, pageSize.x, JOIN_MARGIN)
+        #self.addMarginRectangle(parent, 0, 0, JOIN_MARGIN, pageSize.y)
 
-        self.addMarginRectangle(newRoot, 0, pageSize.y - JOIN_MARGIN, pageSize.x, JOIN_MARGIN)
-        self.addMarginRectangle(newRoot, pageSize.x - JOIN_MARGIN, 0, JOIN_MARGIN, pageSize.y)
+        joinMargin = self.config.joinMargin
+        if joinMargins:
+            self.addMarginRectangle(parent, 0, pageSize.y - joinMargin, pageSize.x, joinMargin, length)
+            self.addMarginRectangle(parent, pageSize.x - joinMargin, 0, joinMargin, pageSize.y, length)
 
         # Add rectangle
-        self.addPageRectangle(newRoot, 0, 0, pageSize.x, pageSize.y)
+        self.addPageRectangle(parent, 0, 0, pageSize.x, pageSize.y, length)
 
         # Add the file name
-        self.addFileName(newRoot, fileName)
+        self.addFileName(parent, fileName, length)
+
+    def writeDefinition(self, xf, identifier):
+        # Writes the layer content as a plain group, without its own
+        # transform, for the pages to reference.
+        attributes = self.node.attrib
+        saved = list(attributes.items())
+        for name in ('transform', attribName('groupmode', INKSCAPE_NS)):
+            attributes.pop(name, None)
+        attributes['id'] = identifier
+        try:
+            xf.write(self.node, pretty_print=True, with_tail=False)
+        finally:
+            attributes.clear()
+            for name, value in saved:
+                attributes[name] = value
+
+    def tileTransform(self, pageSize, i, j):
+        joinMargin = self.config.joinMargin
+        viewPosition = Vector2(i*(pageSize.x - joinMargin), j*(pageSize.y - joinMargin))
+        viewTransform = Matrix.translation(-viewPosition/PIXELS)
+        return viewTransform*self.transform
 
-        with open(fileName, 'w') as f:
-            text = etree.tostring(newRoot, encoding="UTF-8", xml_declaration = True, pretty_print=True)
-            f.write(text)
+    def exportPart(self, template, pageSize, i, j, outdir):
+        fileName = '%s/%s_%d_%d.svg' % (outdir, self.name, i, j)
 
-    def export(self, outdir):
+        head, middle, tail = template
+        transform = self.tileTransform(pageSize, i, j).svgMatrix().encode('ascii')
+        label = escape(fileName)
+        if not isinstance(label, bytes):
+            label = label.encode('utf-8')
+
+        chunks = (head, transform, middle, label, tail)
+        size = sum([len(chunk) for chunk in chunks])
+        if self.keepUnchanged and os.path.isfile(fileName) and os.path.getsize(fileName) == size:
+            with open(fileName, 'rb') as f:
+                if f.read() == b''.join(chunks):
+                    self.statistics.count('unchanged tiles')
+                    return fileName
+
+        with open(fileName, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        self.statistics.count('tiles')
+        self.statistics.count('bytes written', size)
+        return fileName
+
+    def prepareExport(self, cull=True):
+        # Computes the page grid and the shared tile data, returning the
+        # (column, row) pairs of the tiles to export.
         size = self.transformedSized * PIXELS
 
-        margin = PAGE_MARGIN*2
-        joinMargin = JOIN_MARGIN
+        joinMargin = self.config.joinMargin
+        pageSize = self.config.usableSize()
         if size.x > size.y:
             # Landscape
-            pageSize = Vector2(PAGE_HEIGHT - margin, PAGE_WIDTH - margin)
-        else:
-            # Portrait
-            pageSize = Vector2(PAGE_WIDTH - margin, PAGE_HEIGHT - margin)
+            pageSize = Vector2(pageSize.y, pageSize.x)
         columns = int(math.ceil(size.x / (pageSize.x - joinMargin)))
         rows = int(math.ceil(size.y / (pageSize.y - joinMargin)))
+        self.template = None
+        self.pageSize = pageSize
+        self.visiblePaths = None
+        if cull:
+            with self.statistics.stage('tilePaths'):
+                self.visiblePaths = self.tilePaths(pageSize, columns, rows)
+
+        tiles = []
         for i in range(columns):
             for j in range(rows):
-                self.exportPart(pageSize, i, j, outdir)
+                if cull and (i, j) not in self.visiblePaths:
+                    self.statistics.count('skipped tiles')
+                    continue
+                tiles.append((i, j))
+        return tiles
+
+    def exportTile(self, i, j, outdir):
+        if self.template is None:
+            with self.statistics.stage('tileTemplate'):
+                self.template = self.tileTemplate(self.pageSize)
+        template = self.template
+        if self.visiblePaths is not None:
+            visible = self.visiblePaths[(i, j)]
+            if len(visible) < len(self.paths):
+                with self.statistics.stage('culledTemplate'):
+                    template = self.culledTemplate(visible)
+                self.statistics.count('culled paths', len(self.paths) - len(visible))
+        with self.statistics.stage('exportPart'):
+            return self.exportPart(template, self.pageSize, i, j, outdir)
+
+    def export(self, outdir, cull=True):
+        # Returns the names of the tile files.
+        return [self.exportTile(i, j, outdir) for i, j in self.prepareExport(cull)]
     
+def fileDigest(fileName, digest=None):
+    if digest is None:
+        digest = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class GeometryCache:
+    """
+    The parsed path geometry of the layers of an input file, stored in a
+    directory next to it as memory mapped arrays. The cache is keyed by
+    the hash of the file content, so any edit to the file discards it.
+    The command line only uses it with -cache, since it leaves a .tiles
+    directory next to every input.
+    """
+    def __init__(self, fileName):
+        self.directory = fileName + '.tiles'
+        self.digest = fileDigest(fileName, hashlib.sha1(GEOMETRY_CACHE_VERSION.encode('ascii')))
+        self.layers = {}
+        self.modified = False
+        self.load()
+
+    def load(self):
+        # Maps a layer position to the geometry of each of its paths.
+        indexName = os.path.join(self.directory, 'index.json')
+        if not os.path.exists(indexName):
+            return
+        try:
+            with open(indexName, 'r') as f:
+                index = json.load(f)
+            if index['digest'] != self.digest:
+                return
+            points = numpy.load(os.path.join(self.directory, 'points.npy'), mmap_mode='r')
+            segments = numpy.load(os.path.join(self.directory, 'segments.npy'), mmap_mode='r')
+            subpaths = numpy.load(os.path.join(self.directory, 'subpaths.npy'), mmap_mode='r')
+            paths = numpy.load(os.path.join(self.directory, 'paths.npy'))
+            bounds = numpy.load(os.path.join(self.directory, 'bounds.npy'))
+            layers = index['layers']
+        except (IOError, OSError, ValueError, KeyError):
+            print 'Ignoring unreadable geometry cache', self.directory
+            return
+        for position, (first, count) in layers.items():
+            entries = []
+            for (p0, p1, s0, s1, u0, u1), box in zip(paths[first:first + count], bounds[first:first + count]):
+                entries.append((points[p0:p1], segments[0, s0:s1], segments[1, s0:s1], subpaths[0, u0:u1], subpaths[1, u0:u1], box))
+            self.layers[int(position)] = entries
+
+    def layerGeometry(self, position, node):
+        entries = self.layers.get(position)
+        if entries is None:
+            return None
+        return iter(entries)
+
+    def addLayer(self, position, layer):
+        self.layers[position] = [path.getGeometry() for path in layer.paths]
+        self.modified = True
+
+    def save(self):
+        if not self.modified:
+            return
+        layers = {}
+        entries = []
+        for position in sorted(self.layers):
+            layers[str(position)] = (len(entries), len(self.layers[position]))
+            entries += self.layers[position]
+
+        pointCounts = numpy.array([len(entry[0]) for entry in entries], dtype=numpy.int64)
+        segmentCounts = numpy.array([len(entry[1]) for entry in entries], dtype=numpy.int64)
+        subpathCounts = numpy.array([len(entry[3]) for entry in entries], dtype=numpy.int64)
+        paths = numpy.zeros((len(entries), 6), dtype=numpy.int64)
+        for column, counts in enumerate((pointCounts, segmentCounts, subpathCounts)):
+            paths[:, column*2 + 1] = numpy.cumsum(counts)
+            paths[:, column*2] = paths[:, column*2 + 1] - counts
+        arrays = {
+            'points': numpy.concatenate([entry[0] for entry in entries] + [numpy.empty((0, 2))]),
+            'segments': numpy.array([numpy.concatenate([entry[1] for entry in entries] + [numpy.empty(0, dtype=numpy.intp)]),
+                numpy.concatenate([entry[2] for entry in entries] + [numpy.empty(0, dtype=numpy.intp)])], dtype=numpy.int64),
+            'subpaths': numpy.array([numpy.concatenate([entry[3] for entry in entries] + [numpy.empty(0, dtype=numpy.intp)]),
+                numpy.concatenate([entry[4] for entry in entries] + [numpy.empty(0, dtype=numpy.intp)])], dtype=numpy.int64),
+            'paths': paths,
+            'bounds': numpy.array([entry[5] for entry in entries], dtype=numpy.float64).reshape(-1, 2, 2),
+        }
+
+        # The arrays are written aside and renamed over the old ones, which
+        # may still be mapped by the loaded layers. The index goes last, so
+        # an interrupted save is never picked up.
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            indexName = os.path.join(self.directory, 'index.json')
+            if os.path.exists(indexName):
+                os.remove(indexName)
+            for name, array in arrays.items():
+                fileName = os.path.join(self.directory, name + '.npy')
+                with open(fileName + '.tmp', 'wb') as f:
+                    numpy.save(f, array)
+                os.rename(fileName + '.tmp', fileName)
+            with open(indexName, 'w') as f:
+                json.dump({'digest': self.digest, 'layers': layers}, f)
+        except (IOError, OSError):
+            print 'Unable to write the geometry cache', self.directory
+
+class OutlineFile:
+    """
+    The binary outlines written by plush_export.py next to a blueprint. The
+    coordinates are memory mapped and handed to the layers in place of
+    parsing their path data, as a GeometryCache does. The file is ignored
+    unless it was written along with the current content of the blueprint.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName + '.outlines'
+        self.valid = False
+        if os.path.exists(self.fileName):
+            self.load(fileDigest(fileName))
+
+    def load(self, digest):
+        try:
+            data = numpy.memmap(self.fileName, dtype=numpy.uint8, mode='r')
+            header = data[:OUTLINES_HEADER.itemsize].view(OUTLINES_HEADER)[0]
+        except (IOError, OSError, ValueError):
+            print 'Ignoring unreadable outlines', self.fileName
+            return
+        if header['magic'] != OUTLINES_MAGIC or header['coordinateSize'] not in (4, 8):
+            print 'Ignoring unreadable outlines', self.fileName
+            return
+        if header['digest'].decode('ascii') != digest:
+            print 'Ignoring outlines written for another version of the blueprint', self.fileName
+            return
+
+        count = int(header['outlineCount'])
+        offset = OUTLINES_HEADER.itemsize
+        parts = []
+        for dtype, length in (('<u8', count + 1), ('<u8', count + 1), ('<f8', count*3),
+                ('<f%d' % header['coordinateSize'], int(header['pointCount'])*2), ('S1', int(header['nameBytes']))):
+            size = numpy.dtype(dtype).itemsize*length
+            if offset + size > len(data):
+                print 'Ignoring truncated outlines', self.fileName
+                return
+            parts.append(data[offset:offset + size].view(dtype))
+            offset += size
+        self.pointOffsets, nameOffsets, colors, coordinates, names = parts
+        self.colors = colors.reshape(-1, 3)
+        self.coordinates = coordinates.reshape(-1, 2)
+        names = names.tobytes()
+        self.names = [names[int(nameOffsets[i]):int(nameOffsets[i + 1])].decode('utf-8') for i in range(count)]
+        self.valid = True
+
+    def layerGeometry(self, position, node):
+        # Every layer of a blueprint holds the path of one outline. Layers
+        # that do not match it are parsed from their path data.
+        if not self.valid or position >= len(self.names):
+            return None
+        if layerName(node) != self.names[position] or len(node.findall('.//' + tagName('path', SVG_NS))) != 1:
+            return None
+        positions = self.coordinates[self.pointOffsets[position]:self.pointOffsets[position + 1]]
+        count = len(positions)
+        segmentStarts = numpy.arange(1, count)
+        segmentCounts = numpy.ones(max(count - 1, 0), dtype=numpy.intp)
+        subpathStarts = numpy.array([0] if count else [], dtype=numpy.intp)
+        subpathEnds = numpy.array([count] if count else [], dtype=numpy.intp)
+        return iter([(positions, segmentStarts, segmentCounts, subpathStarts, subpathEnds, boundsFromPoints(positions))])
+
+    def addLayer(self, position, layer):
+        pass
+
+    def save(self):
+        pass
+
 class Document(Node):
-    def __init__(self, document):
+    def __init__(self, document, statistics=None, layerNames=None, cache=None, config=None):
         Node.__init__(self, document.getroot())
+        if statistics is None:
+            statistics = Statistics()
+        if config is None:
+            config = TileConfig()
+        self.statistics = statistics
+        self.config = config
         self.layers = []
         self.layerDict = {}
+        self.layerNodes = []
+        self.builtLayers = {}
+        self.cache = cache
         self.units = PIXELS
         self.scale = 1.0
+
+        # Only the selected layers are parsed up front, the rest only when
+        # they are looked up. Layers are identified by their position among
+        # the top level groups, since several of them may share a name.
         for child in self.node:
-            tag = child.tag
-            if tag == tagName('g', SVG_NS):
-                layer = Layer(child)
-                self.layers.append(layer)
-                self.layerDict[layer.name] = layer
+            if child.tag == tagName('g', SVG_NS):
+                self.layerNodes.append(child)
+        for position, node in enumerate(self.layerNodes):
+            if layerNames is None or layerName(node) in layerNames:
+                self.layers.append(self.buildLayer(position))
+        if cache is not None:
+            cache.save()
+
+    def buildLayer(self, position):
+        layer = buildLayer(self.layerNodes[position], position, self.statistics, self.cache, config=self.config)
+        self.builtLayers[position] = layer
+        self.layerDict.setdefault(layer.name, layer)
+        return layer
+
+    def layerAt(self, position):
+        layer = self.builtLayers.get(position)
+        if layer is None:
+            layer = self.buildLayer(position)
+            if self.cache is not None:
+                self.cache.save()
+        return layer
+
+    def getLayer(self, name):
+        # The first layer with that name.
+        for position, node in enumerate(self.layerNodes):
+            if layerName(node) == name:
+                return self.layerAt(position)
+        return None
 
     def scaleLayerWidth(self, layerName, targetWidth):
-        layer = self.layerDict.get(layerName)
-        bbox = layer.getBoundingBox()
-        layerWidth = bbox.getWidth()
-        self.scale = targetWidth / (layerWidth * PIXELS)
+        self.scale = self.getLayer(layerName).scaleForWidth(targetWidth)
 
     def scaleLayerHeight(self, layerName, targetHeight):
-        layer = self.layerDict.get(layerName)
-        bbox = layer.getBoundingBox()
-        layerHeight = bbox.getHeight()
-        self.scale = targetHeight / (layerHeight * PIXELS)
+        self.scale = self.getLayer(layerName).scaleForHeight(targetHeight)
 
     def transformLayers(self):
         print 'Computed scale factor', self.scale
+        with self.statistics.stage('transformScale'):
+            for layer in self.layers:
+                layer.transformScale(self.scale * self.config.unitScale)
+
+    def bakeTransforms(self):
+        with self.statistics.stage('bakeTransforms'):
+            for layer in self.layers:
+                layer.bakeTransforms()
+
+    def sheetSize(self):
+        return self.config.usableSize()
+
+    def packLayers(self):
+        """
+        Packs the layers that fit on a single page onto shared sheets.
+        Returns the sheets, as lists of (layer, placement transform), and
+        the layers that are still too large and have to be tiled.
+        """
+        sheetSize = self.sheetSize()
+        binWidth = sheetSize.x
+        binHeight = sheetSize.y - PACK_LABEL_HEIGHT
+        pieces = []
+        tiled = []
         for layer in self.layers:
-            layer.transformScale(self.scale * UNIT_SCALE)
+            size = layer.transformedSized * PIXELS
+            width = size.x + PACK_SPACING
+            height = size.y + PACK_SPACING
+            fits = (width <= binWidth and height <= binHeight) or (height <= binWidth and width <= binHeight)
+            if layer.paths and fits:
+                pieces.append((width*height, len(pieces), layer, width, height))
+            else:
+                tiled.append(layer)
+
+        # Largest pieces first, each into the first sheet where it fits.
+        pieces.sort(key=lambda piece: (-piece[0], piece[1]))
+        bins = []
+        for area, order, layer, width, height in pieces:
+            for sheet in bins:
+                if sheet.insert(width, height, layer):
+                    break
+            else:
+                sheet = MaxRectsBin(binWidth, binHeight)
+                sheet.insert(width, height, layer)
+                bins.append(sheet)
+
+        sheets = []
+        for sheet in bins:
+            placements = []
+            for layer, x, y, rotated in sheet.placements:
+                # Place the transformed layer, in pixels, inside the sheet.
+                translation = Matrix.translation(Vector2(x + PACK_SPACING*0.5, y + PACK_SPACING*0.5 + PACK_LABEL_HEIGHT) / PIXELS)
+                if rotated:
+                    rotation = Matrix([[0, -1, layer.transformedSized.y], [1, 0, 0]])
+                    placements.append((layer, translation * rotation * layer.transform))
+                else:
+                    placements.append((layer, translation * layer.transform))
+            sheets.append(placements)
+        self.statistics.count('packed layers', len(pieces))
+        self.statistics.count('sheets', len(sheets))
+        return sheets, tiled
+
+    def exportSheet(self, placements, index, outDir):
+        fileName = '%s/packed_%d.svg' % (outDir, index)
+        sheetSize = self.sheetSize()
 
-    def exportLayers(self, outDir):
-        for layer in self.layers:
-            layer.export(outDir)
+        newRoot = etree.Element(tagName('svg', SVG_NS), nsmap=NSMAP)
+        newRoot.attrib['version'] = '1.1'
+        newRoot.attrib['width'] = '%fmm' % sheetSize.x
+        newRoot.attrib['height'] = '%fmm' % sheetSize.y
+        for layer, transform in placements:
+            newLayer = deepcopy(layer.node)
+            newLayer.attrib['transform'] = transform.svgMatrix()
+            newRoot.append(newLayer)
+        placements[0][0].addPageDecorations(newRoot, sheetSize, fileName, False)
+
+        with open(fileName, 'wb') as f:
+            text = etree.tostring(newRoot, encoding="UTF-8", xml_declaration = True, pretty_print=True)
+            f.write(text)
+        self.statistics.count('bytes written', len(text))
+
+    def exportLayers(self, outDir, cull=True, jobs=1, pack=False):
+        layers = self.layers
+        if pack:
+            with self.statistics.stage('packLayers'):
+                sheets, layers = self.packLayers()
+            for index, placements in enumerate(sheets):
+                with self.statistics.stage('exportSheet'):
+                    self.exportSheet(placements, index, outDir)
+
+        if jobs <= 1:
+            for layer in layers:
+                layer.export(outDir, cull)
+            return
+
+        # The workers are forked after the layers are parsed and their tile
+        # templates are built, so they inherit them instead of re-parsing.
+        tileJobs = []
+        for layer in layers:
+            layerIndex = self.layers.index(layer)
+            for i, j in layer.prepareExport(cull):
+                tileJobs.append((layerIndex, i, j))
+            with self.statistics.stage('tileTemplate'):
+                layer.template = layer.tileTemplate(layer.pageSize)
+
+        pool = multiprocessing.Pool(jobs, initializer=setExportJobs, initargs=(self, outDir))
+        try:
+            results = pool.map(exportTileJob, tileJobs, max(1, len(tileJobs) // (jobs*4)))
+        finally:
+            pool.close()
+            pool.join()
+        for statistics in results:
+            self.statistics.merge(statistics)
+
+    def exportPages(self, fileName, cull=True, pack=False):
+        """
+        Writes the tiles of every layer, and the packed sheets, as the pages
+        of a single Inkscape document. Each layer is written once into the
+        defs, and each page shows it through use elements clipped to the page.
+        """
+        # Every page is a label, a size, the placed layers and whether it
+        # joins with the neighbouring tiles.
+        pages = []
+        layers = self.layers
+        if pack:
+            with self.statistics.stage('packLayers'):
+                sheets, layers = self.packLayers()
+            for index, placements in enumerate(sheets):
+                pages.append(('packed_%d' % index, self.sheetSize(), placements, False))
+        for layer in layers:
+            for i, j in layer.prepareExport(cull):
+                pages.append(('%s_%d_%d' % (layer.name, i, j), layer.pageSize, [(layer, layer.tileTransform(layer.pageSize, i, j))], True))
+
+        # Pages are stacked from top to bottom, PAGES_GAP millimeters apart.
+        # The view box makes the user units PIXELS millimeters, like in the
+        # layer content, and every length below is written in them.
+        pageSizes = []
+        offsets = []
+        height = 0.0
+        for label, pageSize, placements, joinMargins in pages:
+            if (pageSize.x, pageSize.y) not in pageSizes:
+                pageSizes.append((pageSize.x, pageSize.y))
+            offsets.append(height)
+            height += pageSize.y + PAGES_GAP
+        height = max(height - PAGES_GAP, 0.0)
+        width = max([size[0] for size in pageSizes] or [0.0])
+
+        with open(fileName, 'wb') as f:
+            with etree.xmlfile(f, encoding='UTF-8') as xf:
+                xf.write_declaration()
+                rootAttributes = OrderedDict([('version', '1.1'), ('width', millimeters(width)), ('height', millimeters(height)),
+                    ('viewBox', '0 0 %s %s' % (userUnits(width), userUnits(height)))])
+                with xf.element(tagName('svg', SVG_NS), rootAttributes, nsmap=PAGES_NSMAP):
+                    xf.write('\n')
+                    with xf.element(tagName('namedview', SODIPODI_NS), {attribName('document-units', INKSCAPE_NS): 'mm'}):
+                        for (label, pageSize, placements, joinMargins), offset in zip(pages, offsets):
+                            xf.write('\n')
+                            writeElement(xf, tagName('page', INKSCAPE_NS), [
+                                ('x', '0'),
+                                ('y', userUnits(offset)),
+                                ('width', userUnits(pageSize.x)),
+                                ('height', userUnits(pageSize.y)),
+                                (attribName('label', INKSCAPE_NS), label)])
+                        xf.write('\n')
+                    xf.write('\n')
+
+                    with self.statistics.stage('pageDefinitions'):
+                        with xf.element(tagName('defs', SVG_NS)):
+                            for index, size in enumerate(pageSizes):
+                                xf.write('\n')
+                                with xf.element(tagName('clipPath', SVG_NS), {'id': 'page-clip-%d' % index}):
+                                    writeElement(xf, tagName('rect', SVG_NS), [('width', userUnits(size[0])), ('height', userUnits(size[1]))])
+                            for index, layer in enumerate(self.layers):
+                                xf.write('\n')
+                                layer.writeDefinition(xf, 'layer-content-%d' % index)
+                            xf.write('\n')
+                    xf.write('\n')
+
+                    for (label, pageSize, placements, joinMargins), offset in zip(pages, offsets):
+                        with self.statistics.stage('exportPage'):
+                            clipIndex = pageSizes.index((pageSize.x, pageSize.y))
+                            pageAttributes = [
+                                ('transform', 'translate(0,%s)' % userUnits(offset)),
+                                ('clip-path', 'url(#page-clip-%d)' % clipIndex)]
+                            with xf.element(tagName('g', SVG_NS), OrderedDict(pageAttributes)):
+                                for layer, transform in placements:
+                                    xf.write('\n')
+                                    writeElement(xf, tagName('use', SVG_NS), [
+                                        (attribName('href', XLINK_NS), '#layer-content-%d' % self.layers.index(layer)),
+                                        ('transform', transform.svgMatrix())])
+
+                                # The decorations are built as for a tile and copied over.
+                                decorations = etree.Element(tagName('g', SVG_NS))
+                                placements[0][0].addPageDecorations(decorations, pageSize, label, joinMargins, userUnits)
+                                for child in decorations:
+                                    xf.write('\n')
+                                    writeElement(xf, child.tag, child.attrib.items(), child.text)
+                                xf.write('\n')
+                            xf.write('\n')
+                        self.statistics.count('pages')
+
+        self.statistics.count('bytes written', os.path.getsize(fileName))
+
+def buildLayer(node, position, statistics, cache=None, store=True, config=None):
+    # Builds the layer from the cached geometry when there is one.
+    geometry = None
+    if cache is not None:
+        geometry = cache.layerGeometry(position, node)
+    with statistics.stage('layer'):
+        layer = Layer(node, statistics, geometry, config)
+    if geometry is not None:
+        statistics.count('cached layers')
+    elif cache is not None and store:
+        cache.addLayer(position, layer)
+    return layer
+
+def iterLayers(fileName, statistics, names=None, cache=None, config=None):
+    """
+    Parses the top level layers of a document one at a time with iterparse,
+    optionally only the ones in names. Each layer subtree is freed once the
+    caller asks for the next one. The cache is only read, since filling it
+    would keep the geometry of every layer in memory.
+    """
+    depth = 0
+    position = 0
+    for event, element in etree.iterparse(fileName, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if element.tag == tagName('g', SVG_NS):
+            if names is None or layerName(element) in names:
+                yield buildLayer(element, position, statistics, cache, False, config)
+            position += 1
+        element.clear()
+        element.getparent().remove(element)
+
+def tileDocument(tree, outDir='.', config=None, statistics=None, scale=1.0, scaleLayer=None, scaleWidth=None, scaleHeight=None,
+        layerNames=None, cache=None, cull=True, jobs=1, pack=False, bake=False, pagesFileName=None):
+    """
+    Tiles a parsed document into outDir, or into the pagesFileName document.
+    Every setting is given explicitly, so it can be called repeatedly from
+    a long lived process. The scale factor is measured on scaleLayer when
+    there is one. Returns the Document.
+    """
+    document = Document(tree, statistics, layerNames, cache, config)
+    document.scale = scale
+    if scaleLayer is not None and scaleWidth is not None:
+        document.scaleLayerWidth(scaleLayer, scaleWidth)
+    if scaleLayer is not None and scaleHeight is not None:
+        document.scaleLayerHeight(scaleLayer, scaleHeight)
+
+    document.transformLayers()
+    if bake:
+        document.bakeTransforms()
+
+    if pagesFileName is not None:
+        document.exportPages(pagesFileName, cull, pack)
+    else:
+        document.exportLayers(outDir, cull, jobs, pack)
+    return document
+
+def streamTiles(fileName, outDir='.', config=None, statistics=None, scale=1.0, scaleLayer=None, scaleWidth=None, scaleHeight=None,
+        layerNames=None, cache=None, cull=True, bake=False):
+    """
+    Tiles a document file one layer at a time, as tileDocument does. The
+    scale layer, if any, is measured in a first pass over the file.
+    """
+    if config is None:
+        config = TileConfig()
+    if statistics is None:
+        statistics = Statistics()
+    if scaleLayer is not None:
+        for layer in iterLayers(fileName, statistics, [scaleLayer], cache, config):
+            if scaleWidth is not None:
+                scale = layer.scaleForWidth(scaleWidth)
+            if scaleHeight is not None:
+                scale = layer.scaleForHeight(scaleHeight)
+            break
+    print 'Computed scale factor', scale
+
+    for layer in iterLayers(fileName, statistics, layerNames, cache, config):
+        with statistics.stage('transformScale'):
+            layer.transformScale(scale * config.unitScale)
+        if bake:
+            with statistics.stage('bakeTransforms'):
+                layer.bakeTransforms()
+        layer.export(outDir, cull)
+
+class WatchedDocument:
+    """
+    Tiles a document file again every time it changes. Each top level layer
+    is hashed with the scale factor, and only the layers whose hash changed
+    are parsed and exported. Their tiles that come out identical are left
+    untouched, and the ones they no longer produce are removed.
+    """
+    def __init__(self, fileName, outDir='.', config=None, statistics=None, scaleLayer=None, scaleWidth=None, scaleHeight=None,
+            layerNames=None, cull=True, bake=False):
+        if config is None:
+            config = TileConfig()
+        if statistics is None:
+            statistics = Statistics()
+        self.fileName = fileName
+        self.outDir = outDir
+        self.config = config
+        self.statistics = statistics
+        self.scaleLayer = scaleLayer
+        self.scaleWidth = scaleWidth
+        self.scaleHeight = scaleHeight
+        self.layerNames = layerNames
+        self.cull = cull
+        self.bake = bake
+        self.modificationTime = None
+        self.layerDigests = {}
+        self.layerTiles = {}
+
+    def changed(self):
+        try:
+            modificationTime = os.stat(self.fileName).st_mtime
+        except OSError:
+            return False
+        if modificationTime == self.modificationTime:
+            return False
+        self.modificationTime = modificationTime
+        return True
+
+    def update(self):
+        try:
+            with self.statistics.stage('parse'):
+                tree = etree.parse(self.fileName)
+        except (IOError, etree.XMLSyntaxError) as e:
+            # Probably caught in the middle of a save, the next one retries.
+            print 'Unable to parse', self.fileName, e
+            return
+
+        # No layer is built up front, only the scale layer and the changed ones.
+        document = Document(tree, self.statistics, set(), None, self.config)
+        if self.scaleLayer is not None and self.scaleWidth is not None:
+            document.scaleLayerWidth(self.scaleLayer, self.scaleWidth)
+        if self.scaleLayer is not None and self.scaleHeight is not None:
+            document.scaleLayerHeight(self.scaleLayer, self.scaleHeight)
+
+        # Layers are told apart by their name and how many layers before
+        # them share it, which survives adding or removing other layers.
+        keys = []
+        occurrences = {}
+        for position, node in enumerate(document.layerNodes):
+            name = layerName(node)
+            occurrences[name] = occurrences.get(name, 0) + 1
+            if self.layerNames is None or name in self.layerNames:
+                keys.append(((name, occurrences[name]), position))
+
+        exported = 0
+        previousTiles = set()
+        for tiles in self.layerTiles.values():
+            previousTiles.update(tiles)
+        layerTiles = {}
+        for key, position in keys:
+            with self.statistics.stage('hashLayer'):
+                digest = hashlib.sha1(etree.tostring(document.layerNodes[position], with_tail=False))
+                digest.update(repr(document.scale).encode('ascii'))
+                digest = digest.hexdigest()
+            if self.layerDigests.get(key) == digest:
+                layerTiles[key] = self.layerTiles[key]
+                continue
+
+            layer = document.layerAt(position)
+            layer.keepUnchanged = True
+            with self.statistics.stage('transformScale'):
+                layer.transformScale(document.scale * self.config.unitScale)
+            if self.bake:
+                with self.statistics.stage('bakeTransforms'):
+                    layer.bakeTransforms()
+            layerTiles[key] = layer.export(self.outDir, self.cull)
+            self.layerDigests[key] = digest
+            exported += 1
+
+        # Layers sharing a name share their tile files, so a file is only
+        # removed once no layer produces it.
+        currentTiles = set()
+        for tiles in layerTiles.values():
+            currentTiles.update(tiles)
+        self.removeTiles(previousTiles - currentTiles)
+        for key in list(self.layerDigests):
+            if key not in layerTiles:
+                del self.layerDigests[key]
+        self.layerTiles = layerTiles
+        print 'Exported %d of %d layers of %s' % (exported, len(keys), self.fileName)
+
+    def removeTiles(self, fileNames):
+        for fileName in fileNames:
+            try:
+                os.remove(fileName)
+            except OSError:
+                pass
+            self.statistics.count('removed tiles')
+
+def writeElement(xf, tag, attributes, text=None):
+    # Elements written through xf.element inherit the namespace declarations
+    # of the document instead of repeating them.
+    with xf.element(tag, OrderedDict(attributes)):
+        if text:
+            xf.write(text)
+
+exportJobsDocument = None
+exportJobsOutDir = None
+
+def setExportJobs(document, outDir):
+    global exportJobsDocument, exportJobsOutDir
+    exportJobsDocument = document
+    exportJobsOutDir = outDir
+
+def exportTileJob(job):
+    layerIndex, i, j = job
+    layer = exportJobsDocument.layers[layerIndex]
+    layer.statistics = Statistics()
+    layer.exportTile(i, j, exportJobsOutDir)
+    return layer.statistics
 
 # Parse the command
 class Program:
     def __init__(self):
-        self.inputFileName = None
+        self.inputFileNames = []
+        self.config = TileConfig()
         self.scaleLayer = None
         self.scaleLayerWidth = None
         self.scaleLayerHeight = None
         self.outDir = '.'
+        self.printStatistics = False
+        self.statisticsFileName = None
+        self.statistics = Statistics()
+        self.cull = True
+        self.jobs = 1
+        self.pagesFileName = None
+        self.pack = False
+        self.stream = False
+        self.layerNames = None
+        self.useCache = False
+        self.useOutlines = True
+        self.bake = False
+        self.watch = False
 
     def parseCommandLine(self):
-        global UNIT_SCALE
-        global PAGE_WIDTH, PAGE_HEIGHT
         i = 1
         while i < len(sys.argv):
             arg = sys.argv[i]
@@ -431,28 +1880,58 @@ class Program:
                 i += 1
                 self.scaleLayerHeight = float(sys.argv[i])
             elif arg == '-mm':
-                UNIT_SCALE = MM
+                self.config.unitScale = MM
             elif arg == '-px':
-                UNIT_SCALE = 1.0
+                self.config.unitScale = 1.0
             elif arg == '-cm':
-                UNIT_SCALE = CM
+                self.config.unitScale = CM
             elif arg == '-m':
-                UNIT_SCALE = M
+                self.config.unitScale = M
             elif arg == '-a4':
-                PAGE_WIDTH = A4_WIDTH
-                PAGE_HEIGHT = A4_HEIGHT
+                self.config.pageWidth = A4_WIDTH
+                self.config.pageHeight = A4_HEIGHT
             elif arg == '-us-letter':
-                PAGE_WIDTH = US_LETTER_WIDTH
-                PAGE_HEIGHT = US_LETTER_HEIGHT
+                self.config.pageWidth = US_LETTER_WIDTH
+                self.config.pageHeight = US_LETTER_HEIGHT
             elif arg == '-chile-legal':
-                PAGE_WIDTH = CHILE_LEGAL_WIDTH
-                PAGE_HEIGHT = CHILE_LEGAL_HEIGHT
+                self.config.pageWidth = CHILE_LEGAL_WIDTH
+                self.config.pageHeight = CHILE_LEGAL_HEIGHT
+            elif arg == '-watch':
+                self.watch = True
+            elif arg == '-bake':
+                self.bake = True
+            elif arg == '-no-outlines':
+                self.useOutlines = False
+            elif arg == '-cache':
+                self.useCache = True
+            elif arg == '-no-cache':
+                self.useCache = False
+            elif arg == '-layers':
+                i += 1
+                self.layerNames = set(sys.argv[i].split(','))
+            elif arg == '-stream':
+                self.stream = True
+            elif arg == '-pack':
+                self.pack = True
+            elif arg == '-pages':
+                i += 1
+                self.pagesFileName = sys.argv[i]
+            elif arg == '-jobs':
+                i += 1
+                self.jobs = int(sys.argv[i])
+            elif arg == '-no-cull':
+                self.cull = False
+            elif arg == '-stats':
+                self.printStatistics = True
+            elif arg == '-stats-json':
+                i += 1
+                self.statisticsFileName = sys.argv[i]
             elif arg == '-usable-scale':
                 i += 1
-                PAGE_WIDTH *= float(sys.argv[i])
-                PAGE_HEIGHT *= float(sys.argv[i])
+                self.config.pageWidth *= float(sys.argv[i])
+                self.config.pageHeight *= float(sys.argv[i])
             else:
-                self.inputFileName = arg
+                self.inputFileNames.append(arg)
 
             i += 1
 
@@ -462,23 +1941,79 @@ class Program:
     def run(self):
         # Parse the command line
         self.parseCommandLine()
-        if self.inputFileName is None:
-            self.printHelp() 
-
-        with open(self.inputFileName, 'r') as f:
-            document = Document(etree.parse(f))
-
-        # Compute the layer scale.
-        if self.scaleLayer is not None and self.scaleLayerWidth is not None:
-            document.scaleLayerWidth(self.scaleLayer, self.scaleLayerWidth)
-        if self.scaleLayer is not None and self.scaleLayerHeight is not None:
-            document.scaleLayerHeight(self.scaleLayer, self.scaleLayerHeight)
-
-        # Transform the layers
-        document.transformLayers()
-
-        # Export the layers
-        document.exportLayers(self.outDir)
-
-Program().run()
-
+        if not self.inputFileNames:
+            self.printHelp()
+            return
+
+        # In batch mode every input goes into its own directory, and its own
+        # pages document.
+        batch = len(self.inputFileNames) > 1
+        watched = []
+        for inputFileName in self.inputFileNames:
+            outDir = self.outDir
+            pagesFileName = self.pagesFileName
+            if batch:
+                baseName = os.path.splitext(os.path.basename(inputFileName))[0]
+                outDir = os.path.join(self.outDir, baseName)
+                if pagesFileName is not None:
+                    root, extension = os.path.splitext(pagesFileName)
+                    pagesFileName = '%s_%s%s' % (root, baseName, extension)
+                elif not os.path.isdir(outDir):
+                    os.makedirs(outDir)
+                print 'Tiling', inputFileName
+            if self.watch:
+                watched.append(WatchedDocument(inputFileName, outDir, self.config, self.statistics, self.scaleLayer, self.scaleLayerWidth,
+                    self.scaleLayerHeight, self.layerNames, self.cull, self.bake))
+            else:
+                self.runFile(inputFileName, outDir, pagesFileName)
+        if watched:
+            self.runWatching(watched)
+
+        self.reportStatistics()
+
+    def runWatching(self, watched):
+        if self.pagesFileName is not None or self.pack or self.jobs > 1 or self.stream:
+            print 'Ignoring -pages, -pack, -jobs and -stream while watching'
+        print 'Watching for changes, press Ctrl+C to stop'
+        try:
+            while True:
+                for document in watched:
+                    if document.changed():
+                        document.update()
+                time.sleep(WATCH_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+
+    def runFile(self, inputFileName, outDir, pagesFileName):
+        # The outlines written by the exporter make the geometry cache useless.
+        cache = None
+        if self.useOutlines:
+            with self.statistics.stage('loadOutlines'):
+                cache = OutlineFile(inputFileName)
+            if not cache.valid:
+                cache = None
+        if cache is None and self.useCache:
+            with self.statistics.stage('loadCache'):
+                cache = GeometryCache(inputFileName)
+
+        if self.stream:
+            if pagesFileName is not None or self.pack or self.jobs > 1:
+                print 'Ignoring -pages, -pack and -jobs, which need every layer at once'
+            streamTiles(inputFileName, outDir, self.config, self.statistics, 1.0, self.scaleLayer, self.scaleLayerWidth, self.scaleLayerHeight,
+                self.layerNames, cache, self.cull, self.bake)
+            return
+
+        with open(inputFileName, 'r') as f:
+            with self.statistics.stage('parse'):
+                tree = etree.parse(f)
+        tileDocument(tree, outDir, self.config, self.statistics, 1.0, self.scaleLayer, self.scaleLayerWidth, self.scaleLayerHeight,
+            self.layerNames, cache, self.cull, self.jobs, self.pack, self.bake, pagesFileName)
+
+    def reportStatistics(self):
+        if self.printStatistics:
+            print self.statistics.summary()
+        if self.statisticsFileName is not None:
+            self.statistics.dump(self.statisticsFileName)
+
+if __name__ == '__main__':
+    Program().run()